@@ -0,0 +1,272 @@
+import argparse
+import contextlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from sqlalchemy import event, func
+
+from data import db_session, metrics, storage, tasks, transcode
+from data.audio import Audio, READY
+from data.users import User
+
+WARMUP = 5
+REQUESTS = 200
+DURATION = 10
+PROCESSES = 4
+SAMPLE_FILE = 'static/audio/1.mp3'
+METRIC_LINE = re.compile(r'^feel_request_db_queries_(sum|count)\{endpoint="([^"]+)"\} (\S+)$')
+
+
+class Scenario:
+    def __init__(self, name, endpoint, method, make_path, make_data=None, login=False):
+        self.name = name
+        self.endpoint = endpoint
+        self.method = method
+        self.make_path = make_path
+        self.make_data = make_data
+        self.login = login
+
+
+def build_scenarios(db_sess):
+    audio_ids = [audio_id for audio_id, in db_sess.query(Audio.id).filter(Audio.status == READY)]
+    user_ids = [user_id for user_id, in db_sess.query(User.id)]
+    words = [name.split()[0] for name, in db_sess.query(Audio.name).filter(Audio.name.isnot(None)).limit(200)]
+    with open(SAMPLE_FILE, 'rb') as file:
+        sample = file.read()
+
+    def publish_data(rng):
+        return {'name': f'bench {rng.random()}', 'author': 'bench', 'genre': 'bench',
+                'file': (io.BytesIO(sample), 'bench.mp3')}
+
+    return [
+        Scenario('title', 'pages.index', 'GET', lambda rng: '/'),
+        Scenario('main', 'pages.site_main', 'GET', lambda rng: '/main/'),
+        Scenario('search', 'pages.site_main', 'GET', lambda rng: f'/main/{rng.choice(words)}'),
+        Scenario('profile', 'pages.user_prof', 'GET', lambda rng: f'/user/{rng.choice(user_ids)}'),
+        Scenario('comments', 'pages.comments', 'GET', lambda rng: f'/comments/{rng.choice(audio_ids)}'),
+        Scenario('api_audios', 'pages.audiolistresource', 'GET', lambda rng: '/api/audios?limit=50'),
+        Scenario('api_audio', 'pages.audioresource', 'GET', lambda rng: f'/api/audios/{rng.choice(audio_ids)}'),
+        Scenario('api_users', 'pages.userlistresource', 'GET', lambda rng: '/api/users?limit=50'),
+        Scenario('like', 'pages.like', 'POST', lambda rng: f'/like/{rng.choice(audio_ids)} main', login=True),
+        Scenario('play', 'pages.play', 'POST', lambda rng: f'/play/{rng.choice(audio_ids)}'),
+        Scenario('publish', 'pages.publish', 'POST', lambda rng: '/publish', publish_data, login=True),
+    ]
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(latencies, elapsed, queries=None, errors=0):
+    result = {'requests': len(latencies), 'errors': errors, 'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed else None,
+              'p50_ms': round(percentile(latencies, 0.5) * 1000, 3) if latencies else None,
+              'p99_ms': round(percentile(latencies, 0.99) * 1000, 3) if latencies else None}
+    if queries is not None:
+        result['sql_per_request'] = queries
+    return result
+
+
+def run_client(app, scenarios, requests, rng, user_id):
+    statements = [0]
+
+    def count(*args):
+        statements[0] += 1
+
+    engine = db_session.get_engine()
+    event.listen(engine, 'before_cursor_execute', count)
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+    anonymous = app.test_client()
+    results = {}
+    try:
+        for scenario in scenarios:
+            current = client if scenario.login else anonymous
+            for _ in range(WARMUP):
+                _client_request(current, scenario, rng)
+            latencies = []
+            statements[0] = 0
+            started = time.perf_counter()
+            for _ in range(requests):
+                begin = time.perf_counter()
+                _client_request(current, scenario, rng)
+                latencies.append(time.perf_counter() - begin)
+            elapsed = time.perf_counter() - started
+            results[scenario.name] = summarize(latencies, elapsed, round(statements[0] / requests, 2))
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    return results
+
+
+def _client_request(client, scenario, rng):
+    data = scenario.make_data(rng) if scenario.make_data else None
+    response = client.open(scenario.make_path(rng), method=scenario.method, data=data,
+                           content_type='multipart/form-data' if data else None)
+    if response.status_code >= 400:
+        raise SystemExit(f'{scenario.name}: {scenario.method} вернул {response.status_code}')
+
+
+def _http_worker(base_url, targets, duration, seed, output):
+    rng = random.Random(seed)
+    latencies = {name: [] for name, _ in targets}
+    errors = {name: 0 for name, _ in targets}
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        name, paths = rng.choice(targets)
+        begin = time.perf_counter()
+        try:
+            with urllib.request.urlopen(base_url + urllib.request.quote(rng.choice(paths), safe='/?=&')) as response:
+                response.read()
+        except urllib.error.URLError:
+            errors[name] += 1
+            continue
+        latencies[name].append(time.perf_counter() - begin)
+    output.put((latencies, errors))
+
+
+def _query_metrics(base_url):
+    totals = {}
+    with urllib.request.urlopen(base_url + '/metrics') as response:
+        for line in response.read().decode().splitlines():
+            found = METRIC_LINE.match(line)
+            if found:
+                kind, endpoint, value = found.groups()
+                totals.setdefault(endpoint, {})[kind] = float(value)
+    return totals
+
+
+def run_http(base_url, scenarios, duration, processes, rng):
+    # Пути выбираются заранее, чтобы процессы-генераторы не ходили в базу
+    targets = [(scenario.name, [scenario.make_path(rng) for _ in range(100)])
+               for scenario in scenarios if scenario.method == 'GET']
+    before = _query_metrics(base_url)
+    output = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=_http_worker, args=(base_url, targets, duration, seed, output))
+               for seed in range(processes)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    collected = [output.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    # Под gunicorn воркеры сбрасывают метрики в общий каталог по таймеру
+    time.sleep(2 * metrics.DUMP_INTERVAL)
+    after = _query_metrics(base_url)
+
+    results = {}
+    for scenario in scenarios:
+        if scenario.method != 'GET':
+            continue
+        latencies = [value for part, _ in collected for value in part[scenario.name]]
+        errors = sum(part[scenario.name] for _, part in collected)
+        previous, current = before.get(scenario.endpoint, {}), after.get(scenario.endpoint, {})
+        count = current.get('count', 0) - previous.get('count', 0)
+        # Несколько сценариев могут делить один endpoint: тогда это среднее по ним
+        queries = round((current.get('sum', 0) - previous.get('sum', 0)) / count, 2) if count else None
+        results[scenario.name] = summarize(latencies, elapsed, queries, errors)
+    return results
+
+
+def _serve(app):
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+def _database_info(db_sess):
+    from data.comments import Comment
+    from data.reactions import Reaction
+    return {'users': db_sess.query(func.count(User.id)).scalar(),
+            'tracks': db_sess.query(func.count(Audio.id)).scalar(),
+            'reactions': db_sess.query(func.count(Reaction.audio_id)).scalar(),
+            'comments': db_sess.query(func.count(Comment.id)).scalar()}
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], check=True, capture_output=True,
+                              text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочное тестирование Feel A Bit')
+    parser.add_argument('db', help='база, созданная bench.seed; копируется во временный каталог')
+    parser.add_argument('--mode', choices=('client', 'http'), default='client')
+    parser.add_argument('--requests', type=int, default=REQUESTS, help='запросов на сценарий (client)')
+    parser.add_argument('--duration', type=float, default=DURATION, help='длительность в секундах (http)')
+    parser.add_argument('--processes', type=int, default=PROCESSES, help='процессов-генераторов (http)')
+    parser.add_argument('--url', help='адрес уже запущенного сервера вместо встроенного (http)')
+    parser.add_argument('--only', nargs='*', help='запустить только эти сценарии')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='файл для JSON-отчёта, по умолчанию stdout')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='feel-bench-')
+    try:
+        db_file = os.path.join(workdir, 'bench.db')
+        shutil.copy(args.db, db_file)
+        with contextlib.redirect_stdout(sys.stderr):
+            db_session.global_init(db_file)
+        # Загруженные в сценарии publish файлы и их варианты не должны попасть в static/audio:
+        # имена вариантов строятся по id треков базы бенчмарка и совпали бы с настоящими
+        storage.configure(storage.LocalBackend(workdir))
+        transcode.VARIANTS_DIR = os.path.join(workdir, 'variants')
+        from main import create_app
+        app = create_app(db_file)
+        app.config['WTF_CSRF_ENABLED'] = False
+
+        rng = random.Random(args.seed)
+        db_sess = db_session.create_session()
+        scenarios = [scenario for scenario in build_scenarios(db_sess) if not args.only or scenario.name in args.only]
+        report = {'commit': _commit(), 'mode': args.mode, 'database': _database_info(db_sess), 'seed': args.seed}
+        user_id = db_sess.query(User.id).order_by(User.id).first()[0]
+        db_sess.close()
+
+        if args.mode == 'client':
+            report['requests_per_scenario'] = args.requests
+            report['scenarios'] = run_client(app, scenarios, args.requests, rng, user_id)
+        else:
+            server = None
+            base_url = args.url.rstrip('/') if args.url else None
+            if not base_url:
+                server, base_url = _serve(app)
+            report.update(duration=args.duration, processes=args.processes)
+            report['scenarios'] = run_http(base_url, scenarios, args.duration, args.processes, rng)
+            if server:
+                server.shutdown()
+        tasks.stop()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
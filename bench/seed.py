@@ -0,0 +1,106 @@
+import argparse
+import datetime
+import itertools
+import os
+import random
+
+from werkzeug.security import generate_password_hash
+
+from data import db_session
+from data.audio import Audio, READY
+from data.comments import Comment
+from data.files import file_hash
+from data.reactions import Reaction, LIKE, DISLIKE
+from data.users import User
+
+SAMPLE_FILE = 'static/audio/1.mp3'
+PASSWORD = 'bench'
+BATCH_SIZE = 5000
+HISTORY_DAYS = 90
+WORDS = ('ночь', 'город', 'река', 'small', 'light', 'dream', 'огонь', 'ветер', 'blue', 'summer', 'зима', 'echo',
+         'дорога', 'storm', 'сердце', 'moon', 'last', 'дом', 'memory', 'путь')
+GENRES = ('Рок', 'Поп', 'Джаз', 'Электроника', 'Хип-хоп', 'Классика', 'Инди', 'Метал')
+
+
+def _title(rng, words=2):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize()
+
+
+def _insert(db_sess, model, rows):
+    for start in range(0, len(rows), BATCH_SIZE):
+        db_sess.bulk_insert_mappings(model, rows[start:start + BATCH_SIZE])
+    db_sess.commit()
+
+
+def seed(db_file, users=100, tracks=1000, reactions=10000, comments=5000, random_seed=1):
+    if os.path.exists(db_file):
+        raise SystemExit(f'Файл {db_file} уже существует')
+    rng = random.Random(random_seed)
+    now = datetime.datetime.now().replace(microsecond=0)
+    db_session.global_init(db_file)
+    db_sess = db_session.create_session()
+    # Хэш пароля считается один раз: werkzeug намеренно медленный
+    hashed_password = generate_password_hash(PASSWORD)
+    _insert(db_sess, User, [
+        {'id': user_id, 'surname': _title(rng, 1), 'name': _title(rng, 1), 'role': rng.choice('23'),
+         'email': f'user{user_id}@bench.local', 'age': rng.randint(14, 70), 'hashed_password': hashed_password,
+         'register_date': now - datetime.timedelta(days=HISTORY_DAYS + 1)}
+        for user_id in range(1, users + 1)])
+
+    sample_hash = file_hash(SAMPLE_FILE)
+    audio_rows = []
+    for audio_id in range(1, tracks + 1):
+        published = now - datetime.timedelta(seconds=rng.randint(0, HISTORY_DAYS * 24 * 60 * 60))
+        audio_rows.append({'id': audio_id, 'file': SAMPLE_FILE, 'file_hash': sample_hash,
+                           'publisher': rng.randint(1, users), 'name': _title(rng, rng.randint(1, 3)),
+                           'author': _title(rng), 'genre': rng.choice(GENRES), 'duration': rng.randint(60, 400),
+                           'bitrate': 320000, 'status': READY, 'likes': 0, 'dislikes': 0, 'comments': '',
+                           'comments_count': 0, 'publish_date': published, 'modified_date': published})
+
+    # Популярность треков распределена неравномерно, как в реальной ленте
+    weights = [1 / audio_id for audio_id in range(1, tracks + 1)]
+    rng.shuffle(weights)
+    cum_weights = list(itertools.accumulate(weights))
+    audio_ids = range(1, tracks + 1)
+    reaction_rows = {}
+    reactions = min(reactions, users * tracks)
+    while len(reaction_rows) < reactions:
+        audio_id = rng.choices(audio_ids, cum_weights=cum_weights)[0]
+        key = (audio_id, rng.randint(1, users))
+        if key not in reaction_rows:
+            value = LIKE if rng.random() < 0.85 else DISLIKE
+            audio = audio_rows[audio_id - 1]
+            audio['likes' if value == LIKE else 'dislikes'] += 1
+            reaction_rows[key] = {'audio_id': audio_id, 'user_id': key[1], 'value': value,
+                                  'created_at': audio['publish_date'] + (now - audio['publish_date']) * rng.random()}
+
+    comment_rows = []
+    for _ in range(comments):
+        audio_id = rng.choices(audio_ids, cum_weights=cum_weights)[0]
+        audio = audio_rows[audio_id - 1]
+        audio['comments_count'] += 1
+        comment_rows.append({'audio_id': audio_id, 'user_id': rng.randint(1, users), 'text': _title(rng, 6),
+                             'created_at': audio['publish_date'] + (now - audio['publish_date']) * rng.random()})
+
+    _insert(db_sess, Audio, audio_rows)
+    _insert(db_sess, Reaction, list(reaction_rows.values()))
+    _insert(db_sess, Comment, comment_rows)
+    db_sess.close()
+    return {'users': users, 'tracks': tracks, 'reactions': len(reaction_rows), 'comments': len(comment_rows),
+            'seed': random_seed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Создать базу для нагрузочного тестирования')
+    parser.add_argument('db', help='путь к новому файлу базы данных')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--tracks', type=int, default=1000)
+    parser.add_argument('--reactions', type=int, default=10000)
+    parser.add_argument('--comments', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=1, help='зерно генератора случайных чисел')
+    args = parser.parse_args()
+    print(seed(args.db, args.users, args.tracks, args.reactions, args.comments, args.seed))
+
+
+if __name__ == '__main__':
+    main()
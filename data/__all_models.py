@@ -1,2 +1,11 @@
 from . import users
-from . import audio
\ No newline at end of file
+from . import audio
+from . import reactions
+from . import comments
+from . import charts
+from . import transcode
+from . import waveforms
+from . import plays
+from . import storage
+from . import recommendations
+from . import events
\ No newline at end of file
@@ -1,10 +1,28 @@
-from flask import jsonify
+import functools
+import gzip
+import hashlib
+import json
+import sqlalchemy
+
+from flask import jsonify, request, make_response
 from flask_restful import reqparse, abort, Resource
 
-from data import db_session
-from data.audio import Audio
+from data import db_session, sweeper, charts
+from data.audio import Audio, DELETED
 from data.users import User
 
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+MAX_IDS = 500
+GZIP_MIN_SIZE = 1024
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Поля, доступные через API; hashed_password и служебные колонки наружу не отдаются
+USER_FIELDS = ('id', 'surname', 'name', 'email', 'role', 'age', 'avatar_img', 'register_date')
+USER_DEFAULT_FIELDS = ('surname', 'name', 'email', 'role', 'age')
+AUDIO_FIELDS = ('id', 'publisher', 'name', 'author', 'genre', 'file', 'duration', 'bitrate', 'status',
+                'likes', 'dislikes', 'comments_count', 'publish_date', 'modified_date')
+
 
 parser = reqparse.RequestParser()
 parser.add_argument('user_surname', required=True)
@@ -14,9 +32,117 @@ parser.add_argument('user_email', required=True, type=bool)
 parser.add_argument('user_role', required=True, type=bool)
 parser.add_argument('user_age', required=True, type=int)
 
+list_parser = reqparse.RequestParser()
+list_parser.add_argument('limit', type=int, location='args', default=DEFAULT_LIMIT)
+list_parser.add_argument('cursor', type=int, location='args')
+list_parser.add_argument('fields', location='args')
+list_parser.add_argument('ids', location='args')
+
+fields_parser = reqparse.RequestParser()
+fields_parser.add_argument('fields', location='args')
+
+
+def _format_date(value):
+    return value.strftime(DATE_FORMAT) if value is not None else None
+
+
+@functools.lru_cache(maxsize=256)
+def compile_serializer(model, fields):
+    # Сериализатор собирается один раз на набор полей вместо обхода модели в SerializerMixin.to_dict
+    converters = []
+    for field in fields:
+        column = getattr(model, field)
+        if isinstance(column.type, sqlalchemy.DateTime):
+            converters.append((field, _format_date))
+        else:
+            converters.append((field, None))
+
+    def serialize(row):
+        return {field: convert(value) if convert else value
+                for (field, convert), value in zip(converters, row)}
+
+    return serialize
+
+
+def parse_fields(raw, allowed, default):
+    if not raw:
+        return default
+    fields = tuple(dict.fromkeys(field.strip() for field in raw.split(',') if field.strip()))
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        abort(400, message=f"Unknown fields: {', '.join(unknown)}")
+    return fields
+
+
+def parse_ids(raw):
+    try:
+        ids = [int(item) for item in raw.split(',') if item.strip()]
+    except ValueError:
+        abort(400, message="ids must be a comma-separated list of integers")
+    if len(ids) > MAX_IDS:
+        abort(400, message=f"No more than {MAX_IDS} ids per request")
+    return ids
+
+
+def select_rows(session, model, fields, query_filter=None):
+    # В SELECT попадают только запрошенные колонки; id нужен для курсора и добавляется всегда
+    columns = [getattr(model, field) for field in fields]
+    query = session.query(model.id, *columns)
+    if query_filter is not None:
+        query = query.filter(query_filter)
+    return query
+
+
+def page_rows(query, model, args):
+    limit = max(1, min(args['limit'] or DEFAULT_LIMIT, MAX_LIMIT))
+    if args['cursor']:
+        query = query.filter(model.id > args['cursor'])
+    rows = query.order_by(model.id).limit(limit + 1).all()
+    next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+def json_response(payload):
+    body = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    compress = len(body) >= GZIP_MIN_SIZE and 'gzip' in request.headers.get('Accept-Encoding', '')
+    response = make_response(body)
+    response.mimetype = 'application/json'
+    # Сжатое и несжатое тело - разные представления, сильные валидаторы у них должны различаться
+    digest = hashlib.md5(body).hexdigest()
+    response.set_etag(f'{digest}-gzip' if compress else digest)
+    response.cache_control.no_cache = True
+    response.vary.add('Accept-Encoding')
+    response = response.make_conditional(request)
+    if compress and response.status_code == 200:
+        response.set_data(gzip.compress(body, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def list_response(session, model, key, allowed, default, query_filter=None):
+    args = list_parser.parse_args()
+    fields = parse_fields(args['fields'], allowed, default)
+    serialize = compile_serializer(model, fields)
+    query = select_rows(session, model, fields, query_filter)
+    if args['ids']:
+        rows = query.filter(model.id.in_(parse_ids(args['ids']))).order_by(model.id).all()
+        next_cursor = None
+    else:
+        rows, next_cursor = page_rows(query, model, args)
+    return json_response({key: [serialize(row[1:]) for row in rows], 'next_cursor': next_cursor})
+
+
+def item_response(session, model, key, item_id, allowed, default, query_filter=None):
+    fields = parse_fields(fields_parser.parse_args()['fields'], allowed, default)
+    query = select_rows(session, model, fields, query_filter).filter(model.id == item_id)
+    row = query.first()
+    if row is None:
+        abort(404, message=f"{model.__name__} {item_id} not found")
+    return json_response({key: compile_serializer(model, fields)(row[1:])})
+
 
 def abort_if_not_found(thing_id, cls):
-    session = db_session.create_session()
+    session = db_session.request_session()
     thing = session.query(cls).get(thing_id)
     if not thing:
         abort(404, message=f"{cls.__name__} {thing_id} not found")
@@ -24,15 +150,12 @@ def abort_if_not_found(thing_id, cls):
 
 class UserResource(Resource):
     def get(self, user_id):
-        abort_if_not_found(user_id, User)
-        session = db_session.create_session()
-        user = session.query(User).get(user_id)
-        return jsonify({'user': user.to_dict(
-            only=('surname', 'name', 'email', 'role', 'age'))})
+        session = db_session.request_session()
+        return item_response(session, User, 'user', user_id, USER_FIELDS, USER_DEFAULT_FIELDS)
 
     def delete(self, user_id):
         abort_if_not_found(user_id, User)
-        session = db_session.create_session()
+        session = db_session.request_session()
         user = session.query(User).get(user_id)
         session.delete(user)
         session.commit()
@@ -41,13 +164,12 @@ class UserResource(Resource):
 
 class UserListResource(Resource):
     def get(self):
-        session = db_session.create_session()
-        users = session.query(User).all()
-        return jsonify({'users': [item.to_dict() for item in users]})
+        session = db_session.request_session()
+        return list_response(session, User, 'users', USER_FIELDS, USER_FIELDS)
 
     def post(self):
         args = parser.parse_args()
-        session = db_session.create_session()
+        session = db_session.request_session()
         user = User(
             surname=args['user_surname'],
             name=args['user_name'],
@@ -63,22 +185,25 @@ class UserListResource(Resource):
 
 class AudioListResource(Resource):
     def get(self):
-        session = db_session.create_session()
-        audios = session.query(Audio).all()
-        return jsonify({'audios': [item.to_dict() for item in audios]})
+        session = db_session.request_session()
+        return list_response(session, Audio, 'audios', AUDIO_FIELDS, AUDIO_FIELDS, Audio.status != DELETED)
+
+
+def abort_if_audio_not_found(audio_id):
+    session = db_session.request_session()
+    if not session.query(Audio.id).filter(Audio.id == audio_id, Audio.status != DELETED).first():
+        abort(404, message=f"Audio {audio_id} not found")
 
 
 class AudioResource(Resource):
     def get(self, audio_id):
-        abort_if_not_found(audio_id, Audio)
-        session = db_session.create_session()
-        audio = session.query(Audio).get(audio_id)
-        return jsonify({'audio': audio.to_dict()})
+        session = db_session.request_session()
+        return item_response(session, Audio, 'audio', audio_id, AUDIO_FIELDS, AUDIO_FIELDS,
+                             Audio.status != DELETED)
 
     def delete(self, audio_id):
-        abort_if_not_found(audio_id, Audio)
-        session = db_session.create_session()
-        audio = session.query(Audio).get(audio_id)
-        session.delete(audio)
-        session.commit()
+        abort_if_audio_not_found(audio_id)
+        session = db_session.request_session()
+        sweeper.tombstone(session, audio_id)
+        charts.invalidate()
         return jsonify({'SUCCESS': 'OK'})
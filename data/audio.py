@@ -1,27 +1,51 @@
 import datetime
 import sqlalchemy
+from sqlalchemy import orm
 from sqlalchemy_serializer import SerializerMixin
 
 from .db_session import SqlAlchemyBase
 
+PROCESSING = 'processing'
+READY = 'ready'
+FAILED = 'failed'
+DELETED = 'deleted'
+
 
 class Audio(SqlAlchemyBase, SerializerMixin):
     __tablename__ = 'audio'
+    __table_args__ = (
+        sqlalchemy.Index('ix_audio_publish_date_id', 'publish_date', 'id'),
+        sqlalchemy.Index('ix_audio_publisher_date_id', 'publisher', 'publish_date', 'id'),
+    )
+    serialize_rules = ('-user',)
 
     id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True, autoincrement=True)
     file = sqlalchemy.Column(sqlalchemy.String, nullable=True)
+    file_hash = sqlalchemy.Column(sqlalchemy.String, nullable=True)
     publisher = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('users.id'))
     name = sqlalchemy.Column(sqlalchemy.String, nullable=True)
     author = sqlalchemy.Column(sqlalchemy.String, nullable=True)
     genre = sqlalchemy.Column(sqlalchemy.String, nullable=True)
     duration = sqlalchemy.Column(sqlalchemy.Integer, nullable=True)
-    likes = sqlalchemy.Column(sqlalchemy.Integer, default=0)
+    bitrate = sqlalchemy.Column(sqlalchemy.Integer, nullable=True)
+    status = sqlalchemy.Column(sqlalchemy.String, default=READY, server_default=READY, nullable=False)
+    likes = sqlalchemy.Column(sqlalchemy.Integer, default=0, index=True)
     dislikes = sqlalchemy.Column(sqlalchemy.Integer, default=0)
     likers = sqlalchemy.Column(sqlalchemy.String, nullable=True)
     dislikers = sqlalchemy.Column(sqlalchemy.String, nullable=True)
     comments = sqlalchemy.Column(sqlalchemy.String, default='')
+    comments_count = sqlalchemy.Column(sqlalchemy.Integer, default=0, server_default='0', nullable=False)
+    plays = sqlalchemy.Column(sqlalchemy.Integer, default=0, server_default='0', nullable=False)
+    # log2 затухающего счётчика прослушиваний, см. plays.trend_weight; NULL - трек ещё не слушали
+    trend = sqlalchemy.Column(sqlalchemy.Float, nullable=True, index=True)
+    # Карточки рисуют волну, только если она уже рассчитана, иначе каждый показ давал бы лишний 404
+    has_waveform = sqlalchemy.Column(sqlalchemy.Boolean, default=False, server_default='0', nullable=False)
     publish_date = sqlalchemy.Column(sqlalchemy.DateTime, default=datetime.datetime.now)
     modified_date = sqlalchemy.Column(sqlalchemy.DateTime, default=datetime.datetime.now)
+    deleted_at = sqlalchemy.Column(sqlalchemy.DateTime, nullable=True)
+    # Растёт при каждом изменении карточки трека, входит в ключ кэша отрисованных фрагментов
+    version = sqlalchemy.Column(sqlalchemy.Integer, default=0, server_default='0', nullable=False)
+    user = orm.relation('User', back_populates='audios')
 
     def __repr__(self):
         return f'<Audio> {self.id} {self.author} {self.name}'
\ No newline at end of file
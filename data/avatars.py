@@ -0,0 +1,110 @@
+import logging
+import os
+import re
+
+from flask import send_from_directory, abort
+from PIL import Image, ImageOps
+
+from . import db_session, tasks
+from .files import save_upload, file_hash
+from .users import User
+
+AVATAR_DIR = 'static/img/avatars'
+UPLOAD_DIR = 'static/img/avatars/uploads'
+LEGACY_PREFIX = '/static/img/users_profiles/'
+SMALL = 48
+MEDIUM = 96
+LARGE = 256
+SIZES = (SMALL, MEDIUM, LARGE)
+FORMAT = 'webp'
+QUALITY = 80
+MAX_AGE = 365 * 24 * 60 * 60
+FILENAME = re.compile(r'^[0-9a-f]{64}_\d+\.webp$')
+
+
+def url(user, size=SMALL):
+    if user.avatar_hash:
+        return f'/avatars/{user.avatar_hash}_{size}.{FORMAT}'
+    return user.avatar_img
+
+
+def _path(avatar_hash, size):
+    return os.path.join(AVATAR_DIR, f'{avatar_hash}_{size}.{FORMAT}')
+
+
+def render(source, avatar_hash):
+    # Одинаковые загрузки дают один хэш: уже нарезанные миниатюры переиспользуются без повторного декодирования
+    if all(os.path.isfile(_path(avatar_hash, size)) for size in SIZES):
+        return
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+        square = ImageOps.fit(image, (LARGE, LARGE), Image.LANCZOS)
+    for size in SIZES:
+        target = _path(avatar_hash, size)
+        thumbnail = square if size == LARGE else square.resize((size, size), Image.LANCZOS)
+        thumbnail.save(target + '.part', FORMAT, quality=QUALITY, method=6)
+        os.replace(target + '.part', target)
+
+
+def _assign(user_id, avatar_hash):
+    db_sess = db_session.create_session()
+    try:
+        # Версия пользователя входит в штамп кэшированных карточек с его аватаром
+        db_sess.query(User).filter(User.id == user_id).update(
+            {User.avatar_hash: avatar_hash, User.version: User.version + 1}, synchronize_session=False)
+        db_sess.commit()
+    finally:
+        db_sess.close()
+
+
+def process(user_id, source, avatar_hash):
+    try:
+        render(source, avatar_hash)
+    except (OSError, Image.DecompressionBombError) as error:
+        logging.warning('Не удалось обработать аватар пользователя %s: %s', user_id, error)
+        return
+    finally:
+        os.remove(source)
+    _assign(user_id, avatar_hash)
+
+
+def save(file):
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    return save_upload(file, UPLOAD_DIR, 'upload')
+
+
+def publish(user_id, source, avatar_hash):
+    return tasks.submit(process, user_id, source, avatar_hash)
+
+
+def send(name):
+    if not FILENAME.match(name):
+        abort(404)
+    response = send_from_directory(os.path.abspath(AVATAR_DIR), name, max_age=MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+def backfill():
+    # Аватары, загруженные до появления миниатюр, лежат как есть в users_profiles
+    db_sess = db_session.create_session()
+    try:
+        pending = db_sess.query(User.id, User.avatar_img).filter(
+            User.avatar_hash.is_(None), User.avatar_img.startswith(LEGACY_PREFIX)).all()
+    finally:
+        db_sess.close()
+    os.makedirs(AVATAR_DIR, exist_ok=True)
+    done = 0
+    for user_id, avatar_img in pending:
+        path = avatar_img.lstrip('/')
+        try:
+            avatar_hash = file_hash(path)
+            render(path, avatar_hash)
+        except (OSError, Image.DecompressionBombError) as error:
+            logging.warning('Не удалось обработать аватар пользователя %s: %s', user_id, error)
+            continue
+        _assign(user_id, avatar_hash)
+        done += 1
+    return done, len(pending)
@@ -0,0 +1,89 @@
+import datetime
+import threading
+import time
+import sqlalchemy
+
+from . import db_session, events
+from .db_session import SqlAlchemyBase
+from .audio import Audio, READY
+from .reactions import Reaction, LIKE
+from .streaming import audio_url
+
+TOP_SIZE = 5
+CACHE_TTL = 60
+REFRESH_INTERVAL = 300
+WINDOWS = {'day': datetime.timedelta(days=1), 'week': datetime.timedelta(weeks=1)}
+ALL_TIME = 'all'
+TRENDING = 'trending'
+CHANNEL = 'charts'
+
+_cache = {}
+_lock = threading.Lock()
+
+
+class ChartEntry(SqlAlchemyBase):
+    __tablename__ = 'charts'
+
+    window = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+    position = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    audio_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('audio.id'), nullable=False)
+    score = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    computed_at = sqlalchemy.Column(sqlalchemy.DateTime, default=datetime.datetime.now)
+
+
+def top(db_sess, window=ALL_TIME, n=TOP_SIZE):
+    key = (window, n)
+    cached = _cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    if window == ALL_TIME:
+        rows = db_sess.query(Audio.id, Audio.file_hash, Audio.name, Audio.likes).filter(
+            Audio.status == READY).order_by(Audio.likes.desc(), Audio.id).limit(n).all()
+    elif window == TRENDING:
+        rows = db_sess.query(Audio.id, Audio.file_hash, Audio.name, Audio.likes).filter(
+            Audio.status == READY, Audio.trend.isnot(None)).order_by(Audio.trend.desc(), Audio.id).limit(n).all()
+    else:
+        rows = db_sess.query(Audio.id, Audio.file_hash, Audio.name, ChartEntry.score).join(
+            ChartEntry, ChartEntry.audio_id == Audio.id).filter(
+            ChartEntry.window == window, Audio.status == READY).order_by(ChartEntry.position).limit(n).all()
+    entries = [[name, audio_url(audio_id, audio_hash), score] for audio_id, audio_hash, name, score in rows]
+    with _lock:
+        _cache[key] = (time.monotonic() + CACHE_TTL, entries)
+    return entries
+
+
+def _clear(payload=None):
+    with _lock:
+        _cache.clear()
+
+
+def invalidate():
+    # Кэш есть у каждого процесса: остальные сбросят свой, получив событие
+    _clear()
+    events.publish_coalesced(CHANNEL, None, {})
+
+
+events.subscribe(CHANNEL, _clear)
+
+
+def refresh(db_sess, n=TOP_SIZE):
+    now = datetime.datetime.now()
+    for window, length in WINDOWS.items():
+        score = sqlalchemy.func.count(Reaction.user_id)
+        rows = db_sess.query(Reaction.audio_id, score).filter(
+            Reaction.value == LIKE, Reaction.created_at >= now - length).group_by(
+            Reaction.audio_id).order_by(score.desc(), Reaction.audio_id).limit(n).all()
+        db_sess.query(ChartEntry).filter(ChartEntry.window == window).delete(synchronize_session=False)
+        db_sess.add_all(ChartEntry(window=window, position=position, audio_id=audio_id,
+                                   score=likes, computed_at=now)
+                        for position, (audio_id, likes) in enumerate(rows))
+    db_sess.commit()
+    invalidate()
+
+
+def refresh_job():
+    db_sess = db_session.create_session()
+    try:
+        refresh(db_sess)
+    finally:
+        db_sess.close()
@@ -0,0 +1,68 @@
+import datetime
+import sqlalchemy
+from sqlalchemy_serializer import SerializerMixin
+
+from .db_session import SqlAlchemyBase
+from .audio import Audio
+from .pagination import keyset_page
+
+PAGE_SIZE = 30
+DATE_FORMAT = '%d/%m/%Y %H:%M'
+
+
+class Comment(SqlAlchemyBase, SerializerMixin):
+    __tablename__ = 'comments'
+    __table_args__ = (
+        sqlalchemy.Index('ix_comments_audio_created', 'audio_id', 'created_at', 'id'),
+    )
+
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True, autoincrement=True)
+    audio_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('audio.id'), nullable=False)
+    user_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('users.id'), nullable=False)
+    text = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+    created_at = sqlalchemy.Column(sqlalchemy.DateTime, default=datetime.datetime.now, nullable=False)
+
+    def __repr__(self):
+        return f'<Comment> {self.id} {self.audio_id} {self.user_id}'
+
+
+def _bump_counter(db_sess, audio_id, delta):
+    db_sess.query(Audio).filter(Audio.id == audio_id).update(
+        {Audio.comments_count: Audio.comments_count + delta, Audio.version: Audio.version + 1},
+        synchronize_session=False)
+
+
+def add(db_sess, audio_id, user_id, text):
+    comment = Comment(audio_id=audio_id, user_id=user_id, text=text)
+    db_sess.add(comment)
+    _bump_counter(db_sess, audio_id, 1)
+    db_sess.commit()
+    return comment
+
+
+def delete(db_sess, comment_id, audio_id):
+    deleted = db_sess.query(Comment).filter(
+        Comment.id == comment_id, Comment.audio_id == audio_id).delete(synchronize_session=False)
+    if deleted:
+        _bump_counter(db_sess, audio_id, -deleted)
+    db_sess.commit()
+    return bool(deleted)
+
+
+def page(db_sess, audio_id, cursor=None, limit=PAGE_SIZE):
+    query = db_sess.query(Comment).filter(Comment.audio_id == audio_id)
+    return keyset_page(query, Comment.created_at, Comment.id, cursor, limit)
+
+
+def migrate_legacy(db_sess):
+    legacy = db_sess.query(Audio).filter(
+        sqlalchemy.func.coalesce(Audio.comments, '') != '').all()
+    for audio in legacy:
+        for comment_data in audio.comments.split('✓'):
+            commentator_id, comment_text, comment_date = comment_data.replace('[', '').replace(']', '').split('Ø', 2)
+            db_sess.add(Comment(audio_id=audio.id, user_id=int(commentator_id), text=comment_text,
+                                created_at=datetime.datetime.strptime(comment_date, DATE_FORMAT)))
+        db_sess.flush()
+        audio.comments_count = db_sess.query(Comment).filter(Comment.audio_id == audio.id).count()
+        audio.comments = ''
+    db_sess.commit()
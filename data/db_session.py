@@ -1,33 +1,138 @@
+import os
+
 import sqlalchemy as sa
 import sqlalchemy.orm as orm
 from sqlalchemy.orm import Session
 import sqlalchemy.ext.declarative as dec
+from flask import g, has_app_context
 
 SqlAlchemyBase = dec.declarative_base()
 
 __factory = None
+__engine = None
+
+POOL_SIZE = int(os.environ.get('FEEL_DB_POOL_SIZE', 5))
+MAX_OVERFLOW = int(os.environ.get('FEEL_DB_MAX_OVERFLOW', 10))
+POOL_TIMEOUT = int(os.environ.get('FEEL_DB_POOL_TIMEOUT', 30))
+POOL_RECYCLE = int(os.environ.get('FEEL_DB_POOL_RECYCLE', 1800))
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': os.environ.get('FEEL_SQLITE_BUSY_TIMEOUT', 5000),
+    'mmap_size': os.environ.get('FEEL_SQLITE_MMAP_SIZE', 256 * 1024 * 1024),
+    'cache_size': os.environ.get('FEEL_SQLITE_CACHE_SIZE', -64 * 1024),
+    'temp_store': 'MEMORY',
+}
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f'PRAGMA {name} = {value}')
+    cursor.close()
+
+
+def create_engine(url):
+    url = sa.engine.make_url(url)
+    options = {'echo': False, 'pool_size': POOL_SIZE, 'max_overflow': MAX_OVERFLOW, 'pool_timeout': POOL_TIMEOUT}
+    if url.get_backend_name() == 'sqlite':
+        # Файловый SQLite по умолчанию открывает соединение на каждую сессию (NullPool),
+        # из-за чего теряются mmap и страничный кэш, поэтому соединения держатся в пуле
+        options['poolclass'] = sa.pool.QueuePool
+        options['connect_args'] = {'check_same_thread': False}
+        engine = sa.create_engine(url, **options)
+        sa.event.listen(engine, 'connect', _set_sqlite_pragmas)
+    else:
+        options['pool_pre_ping'] = True
+        options['pool_recycle'] = POOL_RECYCLE
+        engine = sa.create_engine(url, **options)
+    return engine
 
 
-def global_init(db_file):
-    global __factory
+def global_init(db_file=None, url=None):
+    global __factory, __engine
+
+    url = url or os.environ.get('DATABASE_URL')
+    if not url:
+        if not db_file or not db_file.strip():
+            raise Exception("Необходимо указать файл базы данных.")
+        url = f'sqlite:///{db_file.strip()}'
 
     if __factory:
+        # Модели и сессии общие на процесс, поэтому вторая база не подключается молча вместо первой
+        if sa.engine.make_url(url) != __engine.url:
+            raise Exception(f"Уже подключена другая база данных: {__engine.url!r}")
         return
 
-    if not db_file or not db_file.strip():
-        raise Exception("Необходимо указать файл базы данных.")
-
-    conn_str = f'sqlite:///{db_file.strip()}?check_same_thread=False'
-    print(f"Подключение к базе данных по адресу {conn_str}")
+    engine = create_engine(url)
+    print(f"Подключение к базе данных по адресу {engine.url!r}")
 
-    engine = sa.create_engine(conn_str, echo=False)
+    __engine = engine
     __factory = orm.sessionmaker(bind=engine)
 
-    from . import __all_models
+    from . import __all_models, search, user_stats
 
     SqlAlchemyBase.metadata.create_all(engine)
+    upgrade_schema(engine)
+    search.init(engine)
+
+    db_sess = __factory()
+    try:
+        __all_models.reactions.migrate_legacy(db_sess)
+        __all_models.comments.migrate_legacy(db_sess)
+        user_stats.migrate_legacy(db_sess)
+        __all_models.waveforms.migrate_legacy(db_sess)
+    finally:
+        db_sess.close()
+
+
+def upgrade_schema(engine):
+    # create_all не трогает существующие таблицы, поэтому новые колонки и индексы досоздаются вручную
+    inspector = sa.inspect(engine)
+    with engine.begin() as conn:
+        for table in SqlAlchemyBase.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    ddl = sa.schema.CreateColumn(column).compile(dialect=engine.dialect)
+                    conn.execute(sa.text(f'ALTER TABLE {table.name} ADD COLUMN {ddl}'))
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+
+def get_engine():
+    return __engine
+
+
+def identity():
+    # Строка, одинаковая у всех процессов с этой базой: путь SQLite делается абсолютным, пароль скрывается
+    url = __engine.url
+    if url.get_backend_name() == 'sqlite' and url.database:
+        url = url.set(database=os.path.abspath(url.database))
+    return url.render_as_string(hide_password=True)
 
 
 def create_session() -> Session:
-    global __factory
-    return __factory()
\ No newline at end of file
+    # Сессия принадлежит вызывающему коду, он же её и закрывает
+    return __factory()
+
+
+def request_session() -> Session:
+    # Одна сессия на запрос для представлений; закрывается в remove_session
+    if not has_app_context():
+        return create_session()
+    if 'db_session' not in g:
+        g.db_session = __factory()
+    return g.db_session
+
+
+def remove_session(exception=None):
+    session = g.pop('db_session', None)
+    if session is not None:
+        if exception is not None:
+            session.rollback()
+        session.close()
+
+
+def init_app(app):
+    app.teardown_appcontext(remove_session)
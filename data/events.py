@@ -0,0 +1,138 @@
+import datetime
+import json
+import logging
+import os
+import socket
+import threading
+
+import sqlalchemy
+
+from . import db_session
+from .db_session import SqlAlchemyBase
+
+# Воркеры gunicorn - отдельные процессы, поэтому события между ними идут через общую базу
+POLL_INTERVAL = 0.5
+COALESCE_DELAY = 0.25
+PRUNE_INTERVAL = 300
+RETENTION = datetime.timedelta(minutes=10)
+BATCH_SIZE = 1000
+
+_handlers = {}
+_pending = {}
+_timer = None
+_lock = threading.Lock()
+_last_id = None
+
+
+class Event(SqlAlchemyBase):
+    __tablename__ = 'events'
+    # Без AUTOINCREMENT SQLite после очистки журнала выдаст уже прочитанные номера заново
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True, autoincrement=True)
+    channel = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+    origin = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+    payload = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+    created_at = sqlalchemy.Column(sqlalchemy.DateTime, default=datetime.datetime.now, index=True)
+
+
+def origin():
+    # Воркеры форкаются из одного мастера, поэтому процесс различается по pid, а не по значению при импорте
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def subscribe(channel, handler):
+    _handlers.setdefault(channel, []).append(handler)
+
+
+def _dispatch(channel, payload):
+    for handler in _handlers.get(channel, ()):
+        try:
+            handler(payload)
+        except Exception:
+            logging.exception('Обработчик события %s завершился с ошибкой', channel)
+
+
+def _store(items):
+    if not items:
+        return
+    sender = origin()
+    db_sess = db_session.create_session()
+    try:
+        db_sess.execute(Event.__table__.insert(), [
+            {'channel': channel, 'origin': sender, 'payload': json.dumps(payload, ensure_ascii=False)}
+            for channel, payload in items])
+        db_sess.commit()
+    except sqlalchemy.exc.SQLAlchemyError:
+        # Живые обновления не стоят ошибки запроса: другие процессы просто не узнают об этом событии
+        logging.exception('Не удалось разослать события другим процессам')
+    finally:
+        db_sess.close()
+
+
+def publish(channel, *payloads):
+    # Свой процесс получает события сразу, остальные - при ближайшем опросе журнала
+    for payload in payloads:
+        _dispatch(channel, payload)
+    _store([(channel, payload) for payload in payloads])
+
+
+def publish_coalesced(channel, key, payload):
+    # Из серии быстрых событий с одним ключом рассылается только последнее
+    global _timer
+    with _lock:
+        _pending[(channel, key)] = payload
+        if _timer is None:
+            _timer = threading.Timer(COALESCE_DELAY, flush)
+            _timer.daemon = True
+            _timer.start()
+
+
+def flush():
+    global _pending, _timer
+    with _lock:
+        pending, _pending = _pending, {}
+        _timer = None
+    items = [(channel, payload) for (channel, _), payload in pending.items()]
+    for channel, payload in items:
+        _dispatch(channel, payload)
+    _store(items)
+
+
+def poll(db_sess):
+    global _last_id
+    if _last_id is None:
+        # Процесс начинает с текущего конца журнала: прошлые события ему не нужны
+        _last_id = db_sess.query(sqlalchemy.func.max(Event.id)).scalar() or 0
+        return 0
+    rows = db_sess.query(Event.id, Event.channel, Event.origin, Event.payload).filter(
+        Event.id > _last_id).order_by(Event.id).limit(BATCH_SIZE).all()
+    receiver = origin()
+    for event_id, channel, sender, payload in rows:
+        _last_id = event_id
+        if sender != receiver:
+            _dispatch(channel, json.loads(payload))
+    return len(rows)
+
+
+def poll_job():
+    db_sess = db_session.create_session()
+    try:
+        poll(db_sess)
+    finally:
+        db_sess.close()
+
+
+def prune(db_sess, now=None):
+    threshold = (now or datetime.datetime.now()) - RETENTION
+    deleted = db_sess.query(Event).filter(Event.created_at < threshold).delete(synchronize_session=False)
+    db_sess.commit()
+    return deleted
+
+
+def prune_job():
+    db_sess = db_session.create_session()
+    try:
+        prune(db_sess)
+    finally:
+        db_sess.close()
@@ -0,0 +1,22 @@
+from sqlalchemy import orm
+
+from . import search
+from .audio import Audio, READY, DELETED
+from .pagination import keyset_page
+
+PAGE_SIZE = 20
+
+
+def page(db_sess, cursor=None, search_value=None, limit=PAGE_SIZE):
+    if search_value:
+        return search.page(db_sess, search_value, cursor, limit)
+    query = db_sess.query(Audio).options(orm.joinedload(Audio.user, innerjoin=True)).filter(Audio.status == READY)
+    return keyset_page(query, Audio.publish_date, Audio.id, cursor, limit)
+
+
+def user_page(db_sess, user_id, cursor=None, include_hidden=False, limit=PAGE_SIZE):
+    # Владелец видит и обрабатываемые треки, остальные - только готовые
+    query = db_sess.query(Audio).filter(Audio.publisher == user_id, Audio.status != DELETED)
+    if not include_hidden:
+        query = query.filter(Audio.status == READY)
+    return keyset_page(query, Audio.publish_date, Audio.id, cursor, limit)
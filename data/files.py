@@ -0,0 +1,27 @@
+import hashlib
+import os
+import uuid
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def save_upload(file, directory, extension):
+    # Пишем файл кусками под уникальным именем и сразу считаем хэш, не держа его в памяти целиком
+    filename = f'{uuid.uuid4().hex}.{extension}'
+    path = os.path.join(directory, filename)
+    partial = path + '.part'
+    digest = hashlib.sha256()
+    with open(partial, 'wb') as target:
+        for chunk in iter(lambda: file.stream.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+            target.write(chunk)
+    os.replace(partial, path)
+    return f'{directory}/{filename}', digest.hexdigest()
@@ -0,0 +1,161 @@
+import collections
+import os
+import threading
+
+from flask import render_template
+from markupsafe import Markup
+
+MAX_BYTES = int(os.environ.get('FEEL_FRAGMENT_CACHE_BYTES', 8 * 1024 * 1024))
+DISK_DIR = os.environ.get('FEEL_FRAGMENT_DIR')
+
+FEED = 'feed_card.html'
+PROFILE = 'profile_card.html'
+COMMENTS = 'comments_card.html'
+KINDS = (FEED, PROFILE, COMMENTS)
+# Увеличивается при изменении карточек: фрагменты на диске переживают перезапуск со старой разметкой
+FORMAT = 2
+
+# Метки в закэшированном HTML, на место которых подставляются данные конкретного посетителя
+LIKED = '@@liked@@'
+DISLIKED = '@@disliked@@'
+HIGHLIGHT = 'background-color: silver'
+DELETE_START = '<!--delete-->'
+DELETE_END = '<!--/delete-->'
+
+
+class MemoryBackend:
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, stamp, html):
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (stamp, html)
+            self.size += len(html)
+            # Вытесняем давно не использованные фрагменты, пока не уложимся в лимит
+            while self.size > self.max_bytes and self._entries:
+                self._discard(next(iter(self._entries)))
+
+    def delete(self, key):
+        with self._lock:
+            self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+
+class DiskBackend:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        kind, audio_id = key
+        return os.path.join(self.directory, f'{os.path.splitext(kind)[0]}_{audio_id}.html')
+
+    def get(self, key):
+        try:
+            with open(self._path(key), encoding='utf-8', newline='') as file:
+                stamp, html = file.read().split('\n', 1)
+        except (OSError, ValueError):
+            return None
+        return stamp, html
+
+    def set(self, key, stamp, html):
+        path = self._path(key)
+        with open(path + '.part', 'w', encoding='utf-8', newline='') as file:
+            file.write(f'{stamp}\n{html}')
+        os.replace(path + '.part', path)
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+
+
+class FragmentCache:
+    def __init__(self, memory, disk=None):
+        self.memory = memory
+        self.disk = disk
+
+    def get(self, key, stamp):
+        entry = self.memory.get(key)
+        if entry is None and self.disk is not None:
+            entry = self.disk.get(key)
+            if entry is not None:
+                self.memory.set(key, *entry)
+        if entry is not None and entry[0] == stamp:
+            return entry[1]
+        return None
+
+    def set(self, key, stamp, html):
+        self.memory.set(key, stamp, html)
+        if self.disk is not None:
+            self.disk.set(key, stamp, html)
+
+    def delete(self, key):
+        self.memory.delete(key)
+        if self.disk is not None:
+            self.disk.delete(key)
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+
+cache = FragmentCache(MemoryBackend(), DiskBackend(DISK_DIR) if DISK_DIR else None)
+
+
+def stamp(audio, publisher):
+    # Версии увеличиваются в БД при каждом изменении, поэтому устаревший фрагмент
+    # не совпадёт по штампу даже в другом процессе, который не получил инвалидацию
+    return f'{FORMAT}.{audio.version}.{publisher.version}'
+
+
+def render(kind, track, publisher, build):
+    # build() собирает контекст шаблона и вызывается только при промахе кэша
+    key = (kind, track.id)
+    current = stamp(track, publisher)
+    html = cache.get(key, current)
+    if html is None:
+        html = str(render_template(kind, **build()))
+        cache.set(key, current, html)
+    return html
+
+
+def personalize(html, liked=False, disliked=False, can_delete=False):
+    html = html.replace(LIKED, HIGHLIGHT if liked else '').replace(DISLIKED, HIGHLIGHT if disliked else '')
+    if not can_delete:
+        start = html.find(DELETE_START)
+        if start != -1:
+            html = html[:start] + html[html.find(DELETE_END, start) + len(DELETE_END):]
+    return Markup(html)
+
+
+def invalidate(*audio_ids):
+    for audio_id in audio_ids:
+        for kind in KINDS:
+            cache.delete((kind, audio_id))
@@ -0,0 +1,93 @@
+import datetime
+import logging
+
+from mutagen import MutagenError
+from mutagen.mp3 import MP3
+
+from . import db_session, tasks, transcode, waveforms, user_stats, storage
+from .audio import Audio, PROCESSING, READY, FAILED
+
+DEFAULT_NAME = 'Без названия'
+DEFAULT_AUTHOR = 'Неизвестный исполнитель'
+DEFAULT_GENRE = 'Без жанра'
+ID3_FIELDS = {'name': 'TIT2', 'author': 'TPE1', 'genre': 'TCON'}
+REQUEUE_INTERVAL = 300
+# Дольше этого обработка одного трека не идёт: такой трек потерял свою задачу
+STALE_AFTER = datetime.timedelta(minutes=10)
+
+
+def publish(db_sess, publisher_id, file, author=None, name=None, genre=None):
+    source, file_hash = storage.receive(file)
+    path = storage.reference(db_sess, source, file_hash)
+    audio = Audio(publisher=publisher_id, author=author or None, name=name or None, genre=genre or None,
+                  file=path, file_hash=file_hash, status=PROCESSING)
+    db_sess.add(audio)
+    db_sess.commit()
+    try:
+        storage.put(source, file_hash)
+    finally:
+        # Если файл не лёг на место, обработка пометит трек как failed
+        tasks.submit(process, audio.id)
+    return audio
+
+
+def _tag(tags, frame):
+    if not tags or frame not in tags:
+        return None
+    text = str(tags[frame].text[0]).strip() if tags[frame].text else ''
+    return text or None
+
+
+def _finish(db_sess, audio_id, values):
+    # Переход из processing условный: если трек уже обработал повторно поставленный в очередь вызов,
+    # второй ничего не меняет и не считает трек в профиле дважды
+    values[Audio.version] = Audio.version + 1
+    return db_sess.query(Audio).filter(Audio.id == audio_id, Audio.status == PROCESSING).update(
+        values, synchronize_session=False)
+
+
+def process(audio_id):
+    db_sess = db_session.create_session()
+    try:
+        audio = db_sess.query(Audio).get(audio_id)
+        if not audio or audio.status != PROCESSING:
+            return
+        try:
+            # Файл из хранилища берётся только здесь: при публикации его там ещё нет
+            mp3 = MP3(storage.local_file(audio.file, audio.file_hash))
+        except (MutagenError, OSError):
+            _finish(db_sess, audio_id, {Audio.status: FAILED})
+            db_sess.commit()
+            return
+        values = {Audio.duration: mp3.info.length, Audio.bitrate: mp3.info.bitrate, Audio.status: READY}
+        defaults = {'name': DEFAULT_NAME, 'author': DEFAULT_AUTHOR, 'genre': DEFAULT_GENRE}
+        for field, frame in ID3_FIELDS.items():
+            values[getattr(Audio, field)] = getattr(audio, field) or _tag(mp3.tags, frame) or defaults[field]
+        if not _finish(db_sess, audio_id, values):
+            return
+        user_stats.bump(db_sess, audio.publisher, track_count=1)
+        db_sess.commit()
+    finally:
+        db_sess.close()
+    tasks.submit(transcode.process, audio_id)
+    tasks.submit(waveforms.process, audio_id)
+
+
+def requeue(db_sess, now=None):
+    # Очередь задач живёт в памяти процесса: после перезапуска воркера его треки остаются в processing
+    threshold = (now or datetime.datetime.now()) - STALE_AFTER
+    stale = [audio_id for audio_id, in db_sess.query(Audio.id).filter(
+        Audio.status == PROCESSING, Audio.publish_date <= threshold)]
+    for audio_id in stale:
+        tasks.submit(process, audio_id)
+    return len(stale)
+
+
+def requeue_job():
+    db_sess = db_session.create_session()
+    try:
+        requeued = requeue(db_sess)
+    finally:
+        db_sess.close()
+    if requeued:
+        logging.warning('Повторно поставлены в обработку зависшие треки: %d', requeued)
@@ -0,0 +1,130 @@
+import collections
+import json
+import os
+import queue
+import threading
+
+from . import events
+
+CHANNEL = 'live'
+POLL_INTERVAL = 1.0
+QUEUE_SIZE = 100
+MAX_SUBSCRIPTIONS = 500
+# Соединение занимает поток воркера на всё время подключения, остальные потоки остаются обычным запросам
+MAX_CONNECTIONS = int(os.environ.get('FEEL_LIVE_CONNECTIONS', 4))
+# Код закрытия «повторите позже» (RFC 6455)
+TRY_AGAIN_LATER = 1013
+
+REACTION = 'reaction'
+COMMENT = 'comment'
+COMMENT_DELETED = 'comment_deleted'
+
+
+class Subscriber:
+    def __init__(self):
+        self.audio_ids = set()
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+
+    def put(self, message):
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            # Клиент не успевает читать - пропускаем событие, следующее всё равно принесёт актуальные счётчики
+            pass
+
+    def get(self, timeout=POLL_INTERVAL):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class Hub:
+    # Рассылает события подписчикам своего процесса; между процессами их переносит events
+    def __init__(self):
+        self._subscribers = collections.defaultdict(set)
+        self._lock = threading.Lock()
+
+    def subscribe(self, subscriber, audio_ids):
+        with self._lock:
+            for audio_id in audio_ids:
+                if len(subscriber.audio_ids) >= MAX_SUBSCRIPTIONS:
+                    break
+                subscriber.audio_ids.add(audio_id)
+                self._subscribers[audio_id].add(subscriber)
+
+    def disconnect(self, subscriber):
+        with self._lock:
+            for audio_id in subscriber.audio_ids:
+                subscribers = self._subscribers.get(audio_id)
+                if subscribers is not None:
+                    subscribers.discard(subscriber)
+                    if not subscribers:
+                        del self._subscribers[audio_id]
+            subscriber.audio_ids.clear()
+
+    def publish(self, event):
+        # Сообщение сериализуется один раз для всех подписчиков трека
+        message = json.dumps(event, ensure_ascii=False)
+        with self._lock:
+            subscribers = list(self._subscribers.get(event['audio_id'], ()))
+        for subscriber in subscribers:
+            subscriber.put(message)
+
+
+hub = Hub()
+events.subscribe(CHANNEL, hub.publish)
+_connections = threading.BoundedSemaphore(MAX_CONNECTIONS)
+
+
+def broadcast(event):
+    events.publish(CHANNEL, event)
+
+
+def broadcast_coalesced(event):
+    # Из серии быстрых реакций на один трек подписчики получают только последнее состояние
+    events.publish_coalesced(CHANNEL, event['audio_id'], event)
+
+
+def parse_ids(message):
+    # Клиент досылает {"subscribe": [...]} для карточек, подгруженных после подключения
+    try:
+        audio_ids = json.loads(message).get('subscribe', [])
+        return [int(audio_id) for audio_id in audio_ids]
+    except (AttributeError, TypeError, ValueError):
+        return []
+
+
+def query_ids(value):
+    return [int(audio_id) for audio_id in value.split(',') if audio_id.isdigit()]
+
+
+def serve(ws, audio_ids=()):
+    if not _connections.acquire(blocking=False):
+        ws.close(reason=TRY_AGAIN_LATER)
+        return
+    subscriber = Subscriber()
+    try:
+        hub.subscribe(subscriber, audio_ids)
+        while True:
+            message = ws.receive(timeout=0)
+            while message is not None:
+                hub.subscribe(subscriber, parse_ids(message))
+                message = ws.receive(timeout=0)
+            event = subscriber.get()
+            if event is not None:
+                ws.send(event)
+    finally:
+        hub.disconnect(subscriber)
+        _connections.release()
+
+
+def reaction_event(audio_id, likes, dislikes):
+    return {'type': REACTION, 'audio_id': audio_id, 'likes': likes, 'dislikes': dislikes}
+
+
+def comment_event(audio_id, comments_count, comment=None, comment_id=None):
+    if comment is None:
+        return {'type': COMMENT_DELETED, 'audio_id': audio_id, 'comments_count': comments_count,
+                'comment_id': comment_id}
+    return {'type': COMMENT, 'audio_id': audio_id, 'comments_count': comments_count, 'comment': comment}
@@ -0,0 +1,234 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+
+import jinja2
+from flask import g, request, has_request_context, make_response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+# Порог медленного запроса в миллисекундах; без переменной окружения журнал выключен
+SLOW_REQUEST_MS = float(os.environ.get('FEEL_SLOW_REQUEST_MS', 0)) or None
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Общий каталог для воркеров gunicorn: каждый процесс пишет туда свои значения, /metrics их складывает
+MULTIPROCESS_DIR = os.environ.get('FEEL_METRICS_DIR')
+DUMP_INTERVAL = 1
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    @staticmethod
+    def combine(values, snapshot):
+        for key, value in snapshot:
+            key = tuple(key)
+            values[key] = values.get(key, 0) + value
+
+    def samples(self, values=None):
+        if values is None:
+            with self._lock:
+                values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield f'{self.name}{_format_labels(self.labels, key)} {value}'
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0)
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), list(counts), total] for key, (counts, total) in self._values.items()]
+
+    @staticmethod
+    def combine(values, snapshot):
+        for key, counts, total in snapshot:
+            key = tuple(key)
+            merged, merged_total = values.get(key) or ([0] * len(counts), 0)
+            values[key] = ([a + b for a, b in zip(merged, counts)], merged_total + total)
+
+    def samples(self, values=None):
+        if values is None:
+            with self._lock:
+                values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        names = self.labels + ('le',)
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield f'{self.name}_bucket{_format_labels(names, key + (bound,))} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(self.labels, key)} {total}'
+            yield f'{self.name}_count{_format_labels(self.labels, key)} {cumulative}'
+
+
+requests_total = Counter('feel_requests_total', 'Обработанные HTTP-запросы', ('endpoint', 'method', 'status'))
+request_seconds = Histogram('feel_request_duration_seconds', 'Время обработки запроса',
+                            ('endpoint', 'method'))
+request_queries = Histogram('feel_request_db_queries', 'Число SQL-запросов на один HTTP-запрос',
+                            ('endpoint',), QUERY_BUCKETS)
+request_db_seconds = Histogram('feel_request_db_seconds', 'Суммарное время SQL на один HTTP-запрос',
+                               ('endpoint',))
+template_seconds = Histogram('feel_template_render_seconds', 'Время отрисовки шаблона', ('template',))
+METRICS = (requests_total, request_seconds, request_queries, request_db_seconds, template_seconds)
+
+
+class TimedTemplate(jinja2.Template):
+    def render(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            template_seconds.observe(time.perf_counter() - start, template=self.name)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('metrics_started')
+    if not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    if not has_request_context() or 'metrics_start' not in g:
+        return
+    g.metrics_queries += 1
+    g.metrics_db_seconds += elapsed
+    if SLOW_REQUEST_MS:
+        g.metrics_statements.append((elapsed, statement))
+
+
+def _before_request():
+    g.metrics_start = time.perf_counter()
+    g.metrics_queries = 0
+    g.metrics_db_seconds = 0.0
+    g.metrics_statements = []
+
+
+def _after_request(response):
+    if 'metrics_start' not in g:
+        return response
+    elapsed = time.perf_counter() - g.metrics_start
+    endpoint = request.endpoint or 'unmatched'
+    requests_total.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    request_seconds.observe(elapsed, endpoint=endpoint, method=request.method)
+    request_queries.observe(g.metrics_queries, endpoint=endpoint)
+    request_db_seconds.observe(g.metrics_db_seconds, endpoint=endpoint)
+    if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+        statements = '\n'.join(f'  {seconds * 1000:.1f} мс: {statement}'
+                               for seconds, statement in g.metrics_statements)
+        logging.warning('Медленный запрос %s %s: %.1f мс, SQL: %d за %.1f мс\n%s', request.method,
+                        request.full_path, elapsed * 1000, g.metrics_queries, g.metrics_db_seconds * 1000,
+                        statements)
+    return response
+
+
+def init_app(app):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.jinja_env.template_class = TimedTemplate
+
+
+_files = {}
+
+
+def dump():
+    # Файл назван по pid и времени запуска: воркер с повторно выданным pid не затрёт счётчики прежнего
+    if not MULTIPROCESS_DIR:
+        return
+    path = _files.setdefault(os.getpid(), os.path.join(MULTIPROCESS_DIR, f'{os.getpid()}-{time.time_ns()}.json'))
+    with open(path + '.part', 'w') as file:
+        json.dump({metric.name: metric.snapshot() for metric in METRICS}, file)
+    os.replace(path + '.part', path)
+
+
+def reset():
+    # Вызывается мастером до запуска воркеров: значения прошлого запуска не должны попасть в суммы
+    if not MULTIPROCESS_DIR:
+        return
+    os.makedirs(MULTIPROCESS_DIR, exist_ok=True)
+    for name in os.listdir(MULTIPROCESS_DIR):
+        if name.endswith(('.json', '.part')):
+            os.remove(os.path.join(MULTIPROCESS_DIR, name))
+
+
+def _collect():
+    # Файлы завершившихся воркеров остаются, иначе суммы счётчиков убывали бы после перезапуска воркера
+    dump()
+    values = {metric.name: {} for metric in METRICS}
+    for name in os.listdir(MULTIPROCESS_DIR):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(MULTIPROCESS_DIR, name)) as file:
+                snapshots = json.load(file)
+        except (OSError, ValueError):
+            continue
+        for metric in METRICS:
+            metric.combine(values[metric.name], snapshots.get(metric.name, ()))
+    return values
+
+
+def exposition():
+    values = _collect() if MULTIPROCESS_DIR else {}
+    lines = []
+    for metric in METRICS:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(metric.samples(values.get(metric.name)))
+    return '\n'.join(lines) + '\n'
+
+
+def response():
+    result = make_response(exposition())
+    result.headers['Content-Type'] = CONTENT_TYPE
+    return result
@@ -0,0 +1,34 @@
+import datetime
+import sqlalchemy
+
+CURSOR_DATE_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def encode_cursor(moment, item_id):
+    return f'{moment.strftime(CURSOR_DATE_FORMAT)}-{item_id}'
+
+
+def decode_cursor(cursor):
+    try:
+        moment, item_id = cursor.split('-')
+        return datetime.datetime.strptime(moment, CURSOR_DATE_FORMAT), int(item_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def keyset_page(query, date_column, id_column, cursor, limit):
+    # Постраничная выдача от новых к старым по паре (дата, id) без OFFSET
+    query = query.order_by(date_column.desc(), id_column.desc())
+    position = decode_cursor(cursor) if cursor else None
+    if position:
+        moment, item_id = position
+        query = query.filter(sqlalchemy.or_(
+            date_column < moment,
+            sqlalchemy.and_(date_column == moment, id_column < item_id)))
+    items = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        last = items[-1]
+        next_cursor = encode_cursor(getattr(last, date_column.key), getattr(last, id_column.key))
+    return items, next_cursor
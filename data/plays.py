@@ -0,0 +1,158 @@
+import collections
+import datetime
+import logging
+import math
+import threading
+
+import sqlalchemy
+from sqlalchemy.dialects import postgresql, sqlite
+
+from . import db_session, tasks
+from .db_session import SqlAlchemyBase
+from .audio import Audio, DELETED
+from .users import User
+
+FLUSH_INTERVAL = 10
+# Столько разных треков в буфере запускает внеочередной сброс
+MAX_PENDING = 10000
+TREND_HALF_LIFE = datetime.timedelta(days=1)
+TREND_EPOCH = datetime.datetime(2022, 1, 1)
+
+_pending = collections.Counter()
+_lock = threading.Lock()
+_flushing = threading.Lock()
+
+
+class PlayDaily(SqlAlchemyBase):
+    __tablename__ = 'play_daily'
+
+    audio_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('audio.id'), primary_key=True)
+    day = sqlalchemy.Column(sqlalchemy.Date, primary_key=True)
+    plays = sqlalchemy.Column(sqlalchemy.Integer, default=0, nullable=False)
+
+
+def record(audio_id):
+    # Прослушивание только попадает в буфер: в базу оно уйдёт пачкой при ближайшем сбросе
+    with _lock:
+        _pending[audio_id] += 1
+        overflow = len(_pending) >= MAX_PENDING
+    if overflow:
+        tasks.submit(flush)
+
+
+def _take():
+    global _pending
+    with _lock:
+        pending, _pending = _pending, collections.Counter()
+    return pending
+
+
+def _restore(pending):
+    with _lock:
+        _pending.update(pending)
+
+
+def trend_weight(moment):
+    # Тренд хранится как log2 суммы прослушиваний с весом 2^(t / период полураспада): сравнение
+    # таких сумм равносильно сравнению затухающих счётчиков, но старые значения не нужно пересчитывать
+    return (moment - TREND_EPOCH) / TREND_HALF_LIFE
+
+
+def _log2_add(current, value):
+    if current is None:
+        return value
+    high, low = max(current, value), min(current, value)
+    return high + math.log2(1 + 2 ** (low - high))
+
+
+def _upsert_daily(db_sess, day, counts):
+    rows = [{'audio_id': audio_id, 'day': day, 'plays': plays} for audio_id, plays in counts.items()]
+    dialect = {'sqlite': sqlite, 'postgresql': postgresql}.get(db_sess.bind.dialect.name)
+    if dialect:
+        statement = dialect.insert(PlayDaily)
+        statement = statement.on_conflict_do_update(index_elements=[PlayDaily.audio_id, PlayDaily.day],
+                                                    set_={'plays': PlayDaily.plays + statement.excluded.plays})
+        db_sess.execute(statement, rows)
+        return
+    existing = {audio_id for audio_id, in db_sess.query(PlayDaily.audio_id).filter(
+        PlayDaily.day == day, PlayDaily.audio_id.in_(counts)).with_for_update()}
+    for row in rows:
+        if row['audio_id'] in existing:
+            db_sess.query(PlayDaily).filter(PlayDaily.audio_id == row['audio_id'], PlayDaily.day == day).update(
+                {PlayDaily.plays: PlayDaily.plays + row['plays']}, synchronize_session=False)
+        else:
+            db_sess.add(PlayDaily(**row))
+
+
+def apply(db_sess, pending, now=None):
+    now = now or datetime.datetime.now()
+    audio = Audio.__table__
+    visible = sqlalchemy.and_(audio.c.id == sqlalchemy.bindparam('b_id'), audio.c.status != DELETED)
+    # Счётчики обновляются первыми: транзакция сразу берёт блокировку на запись, и тренд ниже
+    # читается уже под ней, так что параллельный сброс из другого процесса не потеряет прибавку
+    db_sess.execute(audio.update().where(visible).values(plays=audio.c.plays + sqlalchemy.bindparam('b_plays')),
+                    [{'b_id': audio_id, 'b_plays': plays} for audio_id, plays in pending.items()])
+    rows = db_sess.query(Audio.id, Audio.publisher, Audio.trend).filter(
+        Audio.id.in_(pending), Audio.status != DELETED).with_for_update().all()
+    if not rows:
+        db_sess.rollback()
+        return 0
+    counts = {audio_id: pending[audio_id] for audio_id, _, _ in rows}
+    publishers = collections.Counter()
+    for audio_id, publisher, _ in rows:
+        if publisher:
+            publishers[publisher] += counts[audio_id]
+    weight = trend_weight(now)
+
+    db_sess.execute(audio.update().where(audio.c.id == sqlalchemy.bindparam('b_id')).values(
+        trend=sqlalchemy.bindparam('b_trend')),
+        [{'b_id': audio_id, 'b_trend': _log2_add(trend, math.log2(counts[audio_id]) + weight)}
+         for audio_id, _, trend in rows])
+    if publishers:
+        users = User.__table__
+        db_sess.execute(users.update().where(users.c.id == sqlalchemy.bindparam('b_id')).values(
+            total_plays=users.c.total_plays + sqlalchemy.bindparam('b_plays')),
+            [{'b_id': publisher, 'b_plays': plays} for publisher, plays in publishers.items()])
+    _upsert_daily(db_sess, now.date(), counts)
+    db_sess.commit()
+    return sum(counts.values())
+
+
+def flush():
+    # Сброс по таймеру и внеочередной сброс не должны писать одну пачку дважды
+    with _flushing:
+        pending = _take()
+        if not pending:
+            return 0
+        db_sess = db_session.create_session()
+        try:
+            return apply(db_sess, pending)
+        except sqlalchemy.exc.SQLAlchemyError:
+            db_sess.rollback()
+            _restore(pending)
+            raise
+        finally:
+            db_sess.close()
+
+
+def flush_job():
+    flushed = flush()
+    if flushed:
+        logging.debug('Записано прослушиваний: %d', flushed)
+
+
+def recompute_trend(db_sess):
+    # Восстанавливает тренд из дневных сводок: каждый день считается по его середине
+    trends = {}
+    for audio_id, day, plays in db_sess.query(PlayDaily.audio_id, PlayDaily.day, PlayDaily.plays).filter(
+            PlayDaily.plays > 0):
+        moment = datetime.datetime.combine(day, datetime.time(12))
+        trends[audio_id] = _log2_add(trends.get(audio_id), math.log2(plays) + trend_weight(moment))
+    db_sess.query(Audio).update({Audio.trend: None}, synchronize_session=False)
+    audio = Audio.__table__
+    if trends:
+        db_sess.execute(audio.update().where(audio.c.id == sqlalchemy.bindparam('b_id')).values(
+            trend=sqlalchemy.bindparam('b_trend')),
+            [{'b_id': audio_id, 'b_trend': trend} for audio_id, trend in trends.items()])
+    db_sess.commit()
+    return len(trends)
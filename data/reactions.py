@@ -0,0 +1,102 @@
+import datetime
+import sqlalchemy
+from sqlalchemy.exc import IntegrityError
+
+from . import user_stats
+from .db_session import SqlAlchemyBase
+from .audio import Audio
+
+LIKE = 1
+DISLIKE = -1
+
+COUNTERS = {LIKE: Audio.likes, DISLIKE: Audio.dislikes}
+ATTEMPTS = 3
+
+
+class Reaction(SqlAlchemyBase):
+    __tablename__ = 'reactions'
+    __table_args__ = (
+        sqlalchemy.Index('ix_reactions_user_audio', 'user_id', 'audio_id'),
+    )
+
+    # Составной первичный ключ: один пользователь - одна реакция на трек
+    audio_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('audio.id'), primary_key=True)
+    user_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('users.id'), primary_key=True)
+    value = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    created_at = sqlalchemy.Column(sqlalchemy.DateTime, default=datetime.datetime.now, index=True)
+
+    def __repr__(self):
+        return f'<Reaction> {self.audio_id} {self.user_id} {self.value}'
+
+
+def _bump_counters(db_sess, audio_id, deltas):
+    values = {COUNTERS[value]: COUNTERS[value] + delta for value, delta in deltas.items()}
+    values[Audio.version] = Audio.version + 1
+    db_sess.query(Audio).filter(Audio.id == audio_id).update(values, synchronize_session=False)
+    user_stats.bump_publisher(db_sess, audio_id, total_likes=deltas.get(LIKE, 0))
+
+
+def _apply(db_sess, key, audio_id, user_id, previous, value):
+    # Запись условная: если реакцию уже изменил параллельный запрос того же пользователя,
+    # не изменится ни одной строки, и счётчики не трогаются
+    if previous is None:
+        db_sess.add(Reaction(audio_id=audio_id, user_id=user_id, value=value))
+        db_sess.flush()
+        return 1, {value: 1}, value
+    current = key & (Reaction.value == previous)
+    if previous == value:
+        changed = db_sess.query(Reaction).filter(current).delete(synchronize_session=False)
+        return changed, {value: -1}, 0
+    changed = db_sess.query(Reaction).filter(current).update(
+        {Reaction.value: value, Reaction.created_at: datetime.datetime.now()}, synchronize_session=False)
+    return changed, {previous: -1, value: 1}, value
+
+
+def toggle(db_sess, audio_id, user_id, value, attempts=ATTEMPTS):
+    key = (Reaction.audio_id == audio_id) & (Reaction.user_id == user_id)
+    # Чтение идёт вне транзакции на запись (pysqlite открывает её лишь на первом изменении),
+    # поэтому дельты считаются по числу действительно изменённых строк
+    previous = db_sess.query(Reaction.value).filter(key).scalar()
+    try:
+        changed, deltas, current = _apply(db_sess, key, audio_id, user_id, previous, value)
+    except IntegrityError:
+        # Параллельный запрос того же пользователя успел вставить реакцию первым
+        changed = 0
+    if changed:
+        _bump_counters(db_sess, audio_id, deltas)
+        db_sess.commit()
+        return current
+    db_sess.rollback()
+    if attempts <= 1:
+        raise Exception("Реакцию одновременно меняют параллельные запросы.")
+    return toggle(db_sess, audio_id, user_id, value, attempts - 1)
+
+
+def user_reactions(db_sess, user_id, audio_ids):
+    audio_ids = list(audio_ids)
+    if user_id is None or not audio_ids:
+        return {}
+    rows = db_sess.query(Reaction.audio_id, Reaction.value).filter(
+        Reaction.user_id == user_id, Reaction.audio_id.in_(audio_ids))
+    return dict(rows)
+
+
+def migrate_legacy(db_sess):
+    legacy = db_sess.query(Audio).filter(sqlalchemy.or_(
+        sqlalchemy.func.trim(sqlalchemy.func.coalesce(Audio.likers, '')) != '',
+        sqlalchemy.func.trim(sqlalchemy.func.coalesce(Audio.dislikers, '')) != '')).all()
+    for audio in legacy:
+        migrated = {}
+        for value, ids in ((DISLIKE, audio.dislikers), (LIKE, audio.likers)):
+            for user_id in (ids or '').split():
+                migrated[int(user_id)] = value
+        for user_id, value in migrated.items():
+            db_sess.merge(Reaction(audio_id=audio.id, user_id=user_id, value=value,
+                                   created_at=audio.publish_date))
+        db_sess.flush()
+        audio.likes, audio.dislikes = (
+            db_sess.query(Reaction).filter(Reaction.audio_id == audio.id, Reaction.value == value).count()
+            for value in (LIKE, DISLIKE))
+        audio.likers = None
+        audio.dislikers = None
+    db_sess.commit()
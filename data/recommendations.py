@@ -0,0 +1,239 @@
+import collections
+import datetime
+import itertools
+import logging
+import threading
+
+import sqlalchemy
+
+from . import db_session
+from .db_session import SqlAlchemyBase
+from .audio import Audio, READY
+from .reactions import Reaction, LIKE
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+TOP_K = 10
+PANEL_SIZE = 5
+# Меньше общих слушателей - случайное совпадение, а не сходство
+MIN_COMMON = 2
+REFRESH_INTERVAL = 900
+# Снятые лайки в журнале реакций не остаются, их учитывает только полный пересчёт
+FULL_REFRESH_INTERVAL = 24 * 3600
+BATCH_SIZE = 500
+
+_refreshing = threading.Lock()
+
+
+class SimilarTrack(SqlAlchemyBase):
+    __tablename__ = 'similar_tracks'
+
+    audio_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('audio.id'), primary_key=True)
+    position = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    similar_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('audio.id'), nullable=False)
+    score = sqlalchemy.Column(sqlalchemy.Float, nullable=False)
+    computed_at = sqlalchemy.Column(sqlalchemy.DateTime, default=datetime.datetime.now, index=True)
+
+
+class PublisherSimilar(SqlAlchemyBase):
+    __tablename__ = 'publisher_similar'
+
+    user_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('users.id'), primary_key=True)
+    position = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    similar_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('audio.id'), nullable=False)
+    score = sqlalchemy.Column(sqlalchemy.Float, nullable=False)
+
+
+def enabled():
+    return numpy is not None
+
+
+class _Sparse:
+    # Разреженная бинарная матрица в формате CSR: indices[indptr[i]:indptr[i + 1]] - столбцы строки i
+    def __init__(self, rows, columns, n_rows):
+        order = numpy.argsort(rows, kind='stable')
+        self.indices = columns[order]
+        self.indptr = numpy.zeros(n_rows + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(rows, minlength=n_rows), out=self.indptr[1:])
+
+    def row(self, i):
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+    def gather(self, rows):
+        # Столбцы всех перечисленных строк одним массивом, без цикла на Python
+        starts, ends = self.indptr[rows], self.indptr[rows + 1]
+        lengths = ends - starts
+        offsets = numpy.repeat(starts - numpy.cumsum(lengths) + lengths, lengths)
+        return self.indices[offsets + numpy.arange(lengths.sum())]
+
+
+def _load(db_sess):
+    rows = db_sess.query(Reaction.user_id, Reaction.audio_id).join(Audio, Audio.id == Reaction.audio_id).filter(
+        Reaction.value == LIKE, Audio.status == READY).all()
+    if not rows:
+        return None
+    # fromiter по плоскому потоку заметно быстрее numpy.array по списку строк
+    pairs = numpy.fromiter(itertools.chain.from_iterable(rows), dtype=numpy.int64, count=2 * len(rows)).reshape(-1, 2)
+    # Идентификаторы сжимаются в плотные номера строк и столбцов
+    user_ids, users = numpy.unique(pairs[:, 0], return_inverse=True)
+    audio_ids, tracks = numpy.unique(pairs[:, 1], return_inverse=True)
+    by_track = _Sparse(tracks, users, len(audio_ids))
+    by_user = _Sparse(users, tracks, len(user_ids))
+    norms = numpy.sqrt(numpy.diff(by_track.indptr)).astype(numpy.float64)
+    return audio_ids, by_track, by_user, norms
+
+
+def neighbours(track, by_track, by_user, norms, k=TOP_K):
+    # Косинус бинарных векторов: |A ∩ B| / sqrt(|A| * |B|); пересечения считаются bincount по трекам соседей
+    common = numpy.bincount(by_user.gather(by_track.row(track)), minlength=len(norms))
+    common[track] = 0
+    candidates = numpy.flatnonzero(common >= MIN_COMMON)
+    if not len(candidates):
+        return candidates, numpy.empty(0)
+    scores = common[candidates] / (norms[track] * norms[candidates])
+    if len(candidates) > k:
+        best = numpy.argpartition(-scores, k)[:k]
+        candidates, scores = candidates[best], scores[best]
+    order = numpy.lexsort((candidates, -scores))
+    return candidates[order], scores[order]
+
+
+def _positions(ids, values):
+    # Номера строк для идентификаторов; треки без лайков в матрицу не попали и отбрасываются
+    found = numpy.minimum(numpy.searchsorted(ids, values), len(ids) - 1)
+    return numpy.unique(found[ids[found] == values])
+
+
+def _affected(db_sess, since, audio_ids, by_track, by_user):
+    # У трека с новыми реакциями меняется норма, а с ней сходство со всеми треками его слушателей
+    recent = [audio_id for audio_id, in db_sess.query(Reaction.audio_id).filter(
+        Reaction.created_at >= since).distinct()]
+    if not recent:
+        return numpy.empty(0, dtype=numpy.int64)
+    changed = _positions(audio_ids, numpy.array(recent, dtype=numpy.int64))
+    listeners = numpy.unique(by_track.gather(changed))
+    return numpy.union1d(changed, by_user.gather(listeners))
+
+
+def _publisher_rows(db_sess, rows, replaced, full):
+    # Панель в профиле - соседи всех треков автора, кроме его собственных, по сумме сходства
+    owners = dict(db_sess.query(Audio.id, Audio.publisher).filter(Audio.status == READY, Audio.publisher.isnot(None)))
+    if full:
+        publishers = set(owners.values())
+    else:
+        publishers = {owners[audio_id] for audio_id in replaced if audio_id in owners}
+    edges = [(row['audio_id'], row['similar_id'], row['score']) for row in rows]
+    if not full:
+        # Соседи остальных треков этих авторов не пересчитывались и берутся из таблицы
+        replaced = set(replaced)
+        chunks = sorted(publishers)
+        for start in range(0, len(chunks), BATCH_SIZE):
+            edges.extend(edge for edge in db_sess.query(
+                SimilarTrack.audio_id, SimilarTrack.similar_id, SimilarTrack.score).join(
+                Audio, Audio.id == SimilarTrack.audio_id).filter(Audio.publisher.in_(chunks[start:start + BATCH_SIZE]))
+                if edge[0] not in replaced)
+    totals = collections.defaultdict(collections.Counter)
+    for audio_id, similar_id, score in edges:
+        publisher = owners.get(audio_id)
+        if publisher in publishers and owners.get(similar_id) != publisher:
+            totals[publisher][similar_id] += score
+    return publishers, [{'user_id': publisher, 'position': position, 'similar_id': similar_id, 'score': score}
+                        for publisher, scores in totals.items()
+                        for position, (similar_id, score) in enumerate(
+                            sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:TOP_K])]
+
+
+def _replace(db_sess, column, ids, rows):
+    # Строки заменяются пачками в коротких транзакциях: пересчёт держит базу на запись не дольше одной
+    # пачки, а читатель видит у каждого ключа либо все старые строки, либо все новые
+    grouped = collections.defaultdict(list)
+    for row in rows:
+        grouped[row[column.key]].append(row)
+    for start in range(0, len(ids), BATCH_SIZE):
+        chunk = ids[start:start + BATCH_SIZE]
+        db_sess.query(column.class_).filter(column.in_(chunk)).delete(synchronize_session=False)
+        batch = [row for key in chunk for row in grouped[key]]
+        if batch:
+            db_sess.execute(column.class_.__table__.insert(), batch)
+        db_sess.commit()
+
+
+def refresh(db_sess, full=False):
+    # Без full пересчитываются только треки, затронутые реакциями с прошлого запуска
+    started = datetime.datetime.now()
+    full = full or not db_sess.query(PublisherSimilar.user_id).first()
+    since = None if full else db_sess.query(sqlalchemy.func.max(SimilarTrack.computed_at)).scalar()
+    loaded = _load(db_sess)
+    if loaded is None:
+        db_sess.query(SimilarTrack).delete(synchronize_session=False)
+        db_sess.query(PublisherSimilar).delete(synchronize_session=False)
+        db_sess.commit()
+        return 0
+    audio_ids, by_track, by_user, norms = loaded
+    if since is None:
+        targets = numpy.arange(len(audio_ids))
+    else:
+        targets = _affected(db_sess, since, audio_ids, by_track, by_user)
+        if not len(targets):
+            return 0
+        if 2 * len(targets) > len(audio_ids):
+            # Затронута большая часть треков: полный пересчёт дешевле чтения соседей остальных
+            since, targets = None, numpy.arange(len(audio_ids))
+    # Всё считается до первой записи, а пишется уже готовый результат
+    rows = []
+    for track in targets:
+        similar, scores = neighbours(track, by_track, by_user, norms)
+        rows.extend({'audio_id': int(audio_ids[track]), 'position': position,
+                     'similar_id': int(audio_ids[other]), 'score': float(score), 'computed_at': started}
+                    for position, (other, score) in enumerate(zip(similar, scores)))
+    replaced = audio_ids[targets].tolist()
+    publishers, publisher_rows = _publisher_rows(db_sess, rows, replaced, since is None)
+
+    _replace(db_sess, SimilarTrack.audio_id, replaced, rows)
+    _replace(db_sess, PublisherSimilar.user_id, sorted(publishers), publisher_rows)
+    if since is None:
+        # Треки, у которых не осталось лайков, и бывшие авторы полным пересчётом не перезаписаны
+        db_sess.query(SimilarTrack).filter(SimilarTrack.computed_at < started).delete(synchronize_session=False)
+        stale = sorted({user_id for user_id, in db_sess.query(PublisherSimilar.user_id).distinct()} - publishers)
+        _replace(db_sess, PublisherSimilar.user_id, stale, [])
+        db_sess.commit()
+    return len(targets)
+
+
+def _refresh_job(full):
+    if not enabled():
+        return
+    # Быстрый и полный пересчёт в одном процессе не пишут одновременно
+    with _refreshing:
+        db_sess = db_session.create_session()
+        try:
+            refreshed = refresh(db_sess, full=full)
+            if refreshed:
+                logging.debug('Обновлены похожие треки: %d', refreshed)
+        finally:
+            db_sess.close()
+
+
+def refresh_job():
+    _refresh_job(full=False)
+
+
+def full_refresh_job():
+    _refresh_job(full=True)
+
+
+def similar(db_sess, audio_id, n=PANEL_SIZE):
+    # Одно чтение по первичному ключу (audio_id, position), ничего не считается во время запроса
+    return db_sess.query(Audio.id, Audio.name, Audio.author).join(
+        SimilarTrack, SimilarTrack.similar_id == Audio.id).filter(
+        SimilarTrack.audio_id == audio_id, Audio.status == READY).order_by(SimilarTrack.position).limit(n).all()
+
+
+def for_publisher(db_sess, user_id, n=PANEL_SIZE):
+    # Панель посчитана при пересчёте, здесь только чтение по первичному ключу (user_id, position)
+    return db_sess.query(Audio.id, Audio.name, Audio.author).join(
+        PublisherSimilar, PublisherSimilar.similar_id == Audio.id).filter(
+        PublisherSimilar.user_id == user_id, Audio.status == READY).order_by(PublisherSimilar.position).limit(n).all()
@@ -0,0 +1,121 @@
+import re
+import sqlalchemy
+from sqlalchemy import orm
+
+from .audio import Audio, READY
+from .pagination import keyset_page
+
+PAGE_SIZE = 20
+SUGGEST_SIZE = 8
+
+enabled = False
+
+FTS_SCHEMA = (
+    """CREATE VIRTUAL TABLE audio_fts USING fts5(
+        name, author, genre, content='audio', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2')""",
+    """CREATE TRIGGER IF NOT EXISTS audio_fts_ai AFTER INSERT ON audio BEGIN
+        INSERT INTO audio_fts(rowid, name, author, genre) VALUES (new.id, new.name, new.author, new.genre);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS audio_fts_ad AFTER DELETE ON audio BEGIN
+        INSERT INTO audio_fts(audio_fts, rowid, name, author, genre)
+        VALUES ('delete', old.id, old.name, old.author, old.genre);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS audio_fts_au AFTER UPDATE OF id, name, author, genre ON audio BEGIN
+        INSERT INTO audio_fts(audio_fts, rowid, name, author, genre)
+        VALUES ('delete', old.id, old.name, old.author, old.genre);
+        INSERT INTO audio_fts(rowid, name, author, genre) VALUES (new.id, new.name, new.author, new.genre);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS audio_fts_tombstone AFTER UPDATE OF status ON audio
+    WHEN new.status = 'deleted' AND old.status != 'deleted' BEGIN
+        INSERT INTO audio_fts(audio_fts, rowid, name, author, genre)
+        VALUES ('delete', old.id, old.name, old.author, old.genre);
+    END""",
+)
+
+
+def init(engine):
+    global enabled
+    if engine.dialect.name != 'sqlite':
+        return
+    with engine.begin() as conn:
+        exists = conn.execute(sqlalchemy.text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'audio_fts'")).first()
+        try:
+            if not exists:
+                conn.execute(sqlalchemy.text(FTS_SCHEMA[0]))
+            for statement in FTS_SCHEMA[1:]:
+                conn.execute(sqlalchemy.text(statement))
+            if not exists:
+                conn.execute(sqlalchemy.text("INSERT INTO audio_fts(audio_fts) VALUES ('rebuild')"))
+        except sqlalchemy.exc.OperationalError:
+            # SQLite собран без FTS5 - остаёмся на поиске через LIKE
+            return
+    enabled = True
+
+
+def match_expression(search_value):
+    # Каждое слово ищется по префиксу, слова объединяются через AND
+    words = re.findall(r'\w+', search_value)
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def _decode_cursor(cursor):
+    try:
+        rank, audio_id = cursor.split('_')
+        return float(rank), int(audio_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def _ranked_ids(db_sess, expression, cursor, limit):
+    sql = 'SELECT rowid, rank FROM audio_fts WHERE audio_fts MATCH :expression'
+    params = {'expression': expression, 'limit': limit}
+    position = _decode_cursor(cursor) if cursor else None
+    if position:
+        sql += ' AND (rank > :rank OR (rank = :rank AND rowid > :audio_id))'
+        params['rank'], params['audio_id'] = position
+    sql += ' ORDER BY rank, rowid LIMIT :limit'
+    return db_sess.execute(sqlalchemy.text(sql), params).all()
+
+
+def _load_ordered(db_sess, ids):
+    if not ids:
+        return []
+    audios = db_sess.query(Audio).options(orm.joinedload(Audio.user, innerjoin=True)).filter(
+        Audio.id.in_(ids), Audio.status == READY)
+    by_id = {audio.id: audio for audio in audios}
+    return [by_id[audio_id] for audio_id in ids if audio_id in by_id]
+
+
+def _like_filter(query, search_value):
+    pattern = f'%{search_value.strip()}%'
+    return query.filter(Audio.status == READY, sqlalchemy.or_(Audio.name.ilike(pattern), Audio.author.ilike(pattern),
+                                       Audio.genre.ilike(pattern)))
+
+
+def page(db_sess, search_value, cursor=None, limit=PAGE_SIZE):
+    expression = match_expression(search_value)
+    if not expression:
+        return [], None
+    if not enabled:
+        query = _like_filter(db_sess.query(Audio).options(orm.joinedload(Audio.user, innerjoin=True)), search_value)
+        return keyset_page(query, Audio.publish_date, Audio.id, cursor, limit)
+    rows = _ranked_ids(db_sess, expression, cursor, limit + 1)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = f'{rows[-1].rank!r}_{rows[-1].rowid}'
+    return _load_ordered(db_sess, [row.rowid for row in rows]), next_cursor
+
+
+def suggest(db_sess, search_value, limit=SUGGEST_SIZE):
+    expression = match_expression(search_value)
+    if not expression:
+        return []
+    if enabled:
+        ids = [row.rowid for row in _ranked_ids(db_sess, expression, None, limit)]
+        audios = _load_ordered(db_sess, ids)
+    else:
+        audios = _like_filter(db_sess.query(Audio), search_value).order_by(Audio.likes.desc()).limit(limit).all()
+    return [{'id': audio.id, 'name': audio.name, 'author': audio.author} for audio in audios]
@@ -0,0 +1,253 @@
+import datetime
+import logging
+import os
+import shutil
+import tempfile
+
+import sqlalchemy
+from sqlalchemy.dialects import postgresql, sqlite
+
+from .db_session import SqlAlchemyBase
+from .audio import Audio, DELETED
+from .files import save_upload, file_hash
+
+AUDIO_DIR = 'static/audio'
+EXTENSION = 'mp3'
+# Два уровня по два символа хэша: 65536 каталогов, в каждом лишь несколько файлов
+SHARD_LEVELS = 2
+SHARD_WIDTH = 2
+
+
+class Blob(SqlAlchemyBase):
+    __tablename__ = 'blobs'
+
+    hash = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+    size = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    refcount = sqlalchemy.Column(sqlalchemy.Integer, default=0, nullable=False)
+    created_at = sqlalchemy.Column(sqlalchemy.DateTime, default=datetime.datetime.now)
+
+
+def key(content_hash):
+    shards = [content_hash[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(SHARD_LEVELS)]
+    return '/'.join(shards + [f'{content_hash}.{EXTENSION}'])
+
+
+class LocalBackend:
+    def __init__(self, root):
+        self.root = root
+        self.staging_dir = os.path.join(root, 'incoming')
+
+    def path(self, name):
+        return f'{self.root}/{name}'
+
+    def local_path(self, name):
+        return self.path(name)
+
+    def exists(self, name):
+        return os.path.isfile(self.path(name))
+
+    def put(self, source, name):
+        target = self.local_path(name)
+        if os.path.isfile(target):
+            os.remove(source)
+            return
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(source, target)
+
+    def delete(self, name):
+        try:
+            os.remove(self.local_path(name))
+        except FileNotFoundError:
+            pass
+
+
+class ObjectStoreBackend:
+    # Объектное хранилище с интерфейсом boto3-клиента S3; стриминг, mutagen и ffmpeg работают
+    # с локальными файлами, поэтому объекты скачиваются в кэш при первом обращении.
+    # not_found - исключения клиента для отсутствующего объекта, у boto3 это botocore ClientError
+    def __init__(self, client, bucket, cache_dir, not_found=(KeyError,)):
+        self.client = client
+        self.bucket = bucket
+        self.cache_dir = cache_dir
+        self.not_found = not_found
+        self.staging_dir = os.path.join(cache_dir, 'incoming')
+
+    def path(self, name):
+        # Путь в кэше известен заранее, объекта в хранилище при этом может ещё не быть
+        return f'{self.cache_dir}/{name}'
+
+    def local_path(self, name):
+        path = self.path(name)
+        if not os.path.isfile(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Перекодирование и волна скачивают один объект параллельно, у каждого свой временный файл
+            fd, part = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+            os.close(fd)
+            try:
+                self.client.download_file(self.bucket, name, part)
+                os.replace(part, path)
+            except self.not_found:
+                raise FileNotFoundError(name)
+            finally:
+                if os.path.exists(part):
+                    os.remove(part)
+        return path
+
+    def exists(self, name):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=name)
+        except self.not_found:
+            return False
+        return True
+
+    def put(self, source, name):
+        if not self.exists(name):
+            self.client.upload_file(source, self.bucket, name)
+        os.remove(source)
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=name)
+        try:
+            os.remove(f'{self.cache_dir}/{name}')
+        except FileNotFoundError:
+            pass
+
+
+class DirectoryObjectClient:
+    # Локальная замена клиента S3 с тем же подмножеством методов: бакет - это каталог
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, bucket, name):
+        return os.path.join(self.root, bucket, *name.split('/'))
+
+    def head_object(self, Bucket, Key):
+        path = self._path(Bucket, Key)
+        if not os.path.isfile(path):
+            raise KeyError(Key)
+        return {'ContentLength': os.path.getsize(path)}
+
+    def upload_file(self, Filename, Bucket, Key):
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(Filename, path + '.part')
+        os.replace(path + '.part', path)
+
+    def download_file(self, Bucket, Key, Filename):
+        shutil.copyfile(self._path(Bucket, Key), Filename)
+
+    def delete_object(self, Bucket, Key):
+        try:
+            os.remove(self._path(Bucket, Key))
+        except FileNotFoundError:
+            pass
+
+
+backend = LocalBackend(AUDIO_DIR)
+
+
+def configure(new_backend):
+    global backend
+    backend = new_backend
+
+
+def _acquire(db_sess, content_hash, size):
+    values = {'hash': content_hash, 'size': size, 'refcount': 1, 'created_at': datetime.datetime.now()}
+    dialect = {'sqlite': sqlite, 'postgresql': postgresql}.get(db_sess.bind.dialect.name)
+    if dialect:
+        statement = dialect.insert(Blob).values(values)
+        db_sess.execute(statement.on_conflict_do_update(index_elements=[Blob.hash],
+                                                        set_={'refcount': Blob.refcount + 1}))
+    elif not db_sess.query(Blob).filter(Blob.hash == content_hash).update(
+            {Blob.refcount: Blob.refcount + 1}, synchronize_session=False):
+        db_sess.add(Blob(**values))
+
+
+def receive(file):
+    # Загрузка пишется во временный файл, хэш известен только после записи
+    os.makedirs(backend.staging_dir, exist_ok=True)
+    return save_upload(file, backend.staging_dir, EXTENSION)
+
+
+def reference(db_sess, source, content_hash):
+    # Ссылка учитывается в транзакции вызывающего кода; файл кладётся через put только после её коммита,
+    # иначе release, не видя незакоммиченной ссылки, удалит файл, который put счёл уже лежащим на месте.
+    # Поэтому хранилище здесь не трогается: возвращается только будущий путь, файл берётся через local_file
+    _acquire(db_sess, content_hash, os.path.getsize(source))
+    return backend.path(key(content_hash))
+
+
+def put(source, content_hash):
+    # Повторная загрузка того же файла не занимает места
+    try:
+        backend.put(source, key(content_hash))
+    finally:
+        # Неудачная загрузка не оставляет временный файл в incoming
+        if os.path.exists(source):
+            os.remove(source)
+
+
+def local_file(path, content_hash):
+    # Локальный путь к файлу трека; объект из хранилища скачивается при первом обращении.
+    # FileNotFoundError, если файла нет
+    if managed(path, content_hash):
+        return backend.local_path(key(content_hash))
+    if not path or not os.path.isfile(path):
+        raise FileNotFoundError(path)
+    return path
+
+
+def release(db_sess, content_hash):
+    # Возвращает True, если это была последняя ссылка и файл удалён; коммитит сессию
+    db_sess.query(Blob).filter(Blob.hash == content_hash).update(
+        {Blob.refcount: Blob.refcount - 1}, synchronize_session=False)
+    orphaned = db_sess.query(Blob).filter(Blob.hash == content_hash, Blob.refcount <= 0).delete(
+        synchronize_session=False)
+    if orphaned:
+        # Файл удаляется до коммита: строка остаётся заблокированной, и параллельная загрузка того же
+        # содержимого дождётся конца транзакции, а свой файл положит уже в пустое место
+        try:
+            backend.delete(key(content_hash))
+        except Exception:
+            db_sess.rollback()
+            raise
+    db_sess.commit()
+    return bool(orphaned)
+
+
+def managed(path, content_hash):
+    # Файлы, загруженные до появления хранилища, лежат по старым путям и счётчика ссылок не имеют
+    return bool(path and content_hash) and path.endswith(key(content_hash))
+
+
+def migrate(db_sess):
+    # Переносит файлы, загруженные до появления хранилища, в шардированное дерево
+    audios = db_sess.query(Audio).filter(Audio.status != DELETED, Audio.file.isnot(None)).all()
+    legacy = set()
+    for audio in audios:
+        if managed(audio.file, audio.file_hash) or not os.path.isfile(audio.file):
+            continue
+        content_hash = file_hash(audio.file)
+        os.makedirs(backend.staging_dir, exist_ok=True)
+        staged = os.path.join(backend.staging_dir, f'{content_hash}.{EXTENSION}.migrate')
+        try:
+            shutil.copyfile(audio.file, staged)
+            path = reference(db_sess, staged, content_hash)
+            db_sess.commit()
+        except OSError as error:
+            logging.warning('Не удалось перенести файл трека %s: %s', audio.id, error)
+            db_sess.rollback()
+            continue
+        try:
+            put(staged, content_hash)
+        except OSError as error:
+            logging.warning('Не удалось перенести файл трека %s: %s', audio.id, error)
+            release(db_sess, content_hash)
+            continue
+        # Старый файл может делить несколько треков, поэтому он удаляется после переноса всех
+        legacy.add(audio.file)
+        audio.file, audio.file_hash = path, content_hash
+        db_sess.commit()
+    for path in legacy:
+        os.remove(path)
+    return len(legacy)
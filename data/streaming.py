@@ -0,0 +1,74 @@
+import os
+
+from flask import current_app, send_file, make_response, abort
+
+from . import storage, transcode
+from .audio import Audio, DELETED
+from .files import file_hash
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+REVALIDATE_MAX_AGE = 0
+VERSION_LENGTH = 12
+
+
+def audio_url(audio_id, audio_hash, quality=None):
+    # Хэш содержимого в URL позволяет кэшировать файл навсегда: новая версия получит новый адрес
+    params = []
+    if audio_hash:
+        params.append(f'v={audio_hash[:VERSION_LENGTH]}')
+    if quality:
+        params.append(f'q={quality}')
+    return f'/stream/{audio_id}' + ('?' + '&'.join(params) if params else '')
+
+
+def is_current(content_hash, version):
+    # Пустой или укороченный v= совпал бы с началом любого хэша, а навсегда кэшировать можно только точный
+    return bool(content_hash) and version is not None and len(version) == VERSION_LENGTH and \
+        content_hash.startswith(version)
+
+
+def send_audio(db_sess, audio_id, version=None, quality=None, headers=None):
+    audio = db_sess.query(Audio).filter(Audio.id == audio_id, Audio.status != DELETED).first()
+    if not audio:
+        abort(404)
+    try:
+        source = storage.local_file(audio.file, audio.file_hash)
+    except FileNotFoundError:
+        abort(404)
+    if not audio.file_hash:
+        audio.file_hash = file_hash(source)
+        db_sess.commit()
+    immutable = is_current(audio.file_hash, version)
+    path, etag = source, audio.file_hash
+    chosen = transcode.choose_quality(quality, headers or {})
+    audio_variant = transcode.variant(db_sess, audio.id, chosen)
+    if audio_variant and os.path.isfile(audio_variant.file):
+        path, etag = audio_variant.file, audio_variant.file_hash
+    elif chosen != transcode.ORIGINAL:
+        # Вариант ещё не готов: отдаём оригинал, но не фиксируем его в кэше под этим адресом
+        immutable = False
+    max_age = IMMUTABLE_MAX_AGE if immutable else REVALIDATE_MAX_AGE
+
+    accel_prefix = current_app.config.get('AUDIO_X_ACCEL_PREFIX')
+    if accel_prefix:
+        # Байты отдаёт nginx (в том числе Range), приложение только проверяет доступ и ставит заголовки
+        response = make_response('')
+        location = os.path.relpath(path, 'static/audio').replace(os.sep, '/')
+        response.headers['X-Accel-Redirect'] = accel_prefix.rstrip('/') + '/' + location
+        response.mimetype = 'audio/mpeg'
+        response.set_etag(etag)
+        response.cache_control.max_age = max_age
+    else:
+        # send_file сам обрабатывает Range (206), If-None-Match/If-Modified-Since (304)
+        # и отдаёт файл через wsgi.file_wrapper (sendfile), а при USE_X_SENDFILE - через X-Sendfile
+        response = send_file(os.path.abspath(path), mimetype='audio/mpeg', conditional=True,
+                             etag=etag, max_age=max_age)
+        response.accept_ranges = 'bytes'
+    response.cache_control.public = True
+    if quality not in transcode.QUALITIES:
+        response.vary.update(transcode.CLIENT_HINTS)
+    if immutable:
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
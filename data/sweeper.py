@@ -0,0 +1,65 @@
+import datetime
+import logging
+import os
+
+from . import db_session, user_stats, storage
+from .audio import Audio, READY, DELETED
+from .transcode import AudioVariant
+from .waveforms import Waveform
+
+SWEEP_INTERVAL = 600
+GRACE_PERIOD = datetime.timedelta(minutes=10)
+BATCH_SIZE = 100
+
+
+def tombstone(db_sess, audio_id):
+    # Удаление - это одна строка UPDATE: id и файлы остальных треков не меняются
+    audio = db_sess.query(Audio.publisher, Audio.status, Audio.likes, Audio.plays).filter(
+        Audio.id == audio_id, Audio.status != DELETED).first()
+    if not audio:
+        return False
+    updated = db_sess.query(Audio).filter(Audio.id == audio_id, Audio.status == audio.status).update(
+        {Audio.status: DELETED, Audio.deleted_at: datetime.datetime.now()}, synchronize_session=False)
+    if updated:
+        user_stats.bump(db_sess, audio.publisher, track_count=-1 if audio.status == READY else 0,
+                        total_likes=-(audio.likes or 0), total_plays=-audio.plays)
+    db_sess.commit()
+    return bool(updated)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as error:
+        logging.warning('Не удалось удалить файл %s: %s', path, error)
+
+
+def sweep(db_sess, now=None):
+    # Файлы удаляются с задержкой, чтобы не оборвать уже начатые воспроизведения
+    threshold = (now or datetime.datetime.now()) - GRACE_PERIOD
+    audios = db_sess.query(Audio).filter(
+        Audio.status == DELETED, Audio.file.isnot(None), Audio.deleted_at <= threshold).limit(BATCH_SIZE).all()
+    for audio in audios:
+        for variant in db_sess.query(AudioVariant).filter(AudioVariant.audio_id == audio.id):
+            _remove(variant.file)
+            db_sess.delete(variant)
+        db_sess.query(Waveform).filter(Waveform.audio_id == audio.id).delete(synchronize_session=False)
+        path, audio.file = audio.file, None
+        # release коммитит сессию, поэтому ссылка снимается вместе с обнулением пути и не снимется дважды
+        if storage.managed(path, audio.file_hash):
+            storage.release(db_sess, audio.file_hash)
+        else:
+            _remove(path)
+    db_sess.commit()
+    return len(audios)
+
+
+def sweep_job():
+    db_sess = db_session.create_session()
+    try:
+        while sweep(db_sess) == BATCH_SIZE:
+            pass
+    finally:
+        db_sess.close()
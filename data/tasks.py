@@ -0,0 +1,90 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from . import db_session
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+WORKERS = int(os.environ.get('FEEL_TASK_WORKERS', 4))
+LOCK_DIR = os.environ.get('FEEL_LOCK_DIR', tempfile.gettempdir())
+
+_stop = threading.Event()
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def configure(executor):
+    # Позволяет подменить пул: например, ProcessPoolExecutor или синхронный исполнитель в тестах
+    global _executor
+    with _executor_lock:
+        previous, _executor = _executor, executor
+    if previous is not None:
+        previous.shutdown(wait=False)
+
+
+def submit(func, *args, **kwargs):
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix='feel-task')
+        executor = _executor
+    return executor.submit(_run, func, *args, **kwargs)
+
+
+def _lock_name(func):
+    # Имя функции не уникально (refresh_job есть в нескольких модулях), а на одной машине могут
+    # работать несколько копий приложения со своими базами
+    database = hashlib.sha1(db_session.identity().encode()).hexdigest()[:12]
+    return f'feel-{database}-{func.__module__}.{func.__qualname__}.lock'
+
+
+def _acquire(func):
+    # Блокировка держится до конца процесса; когда он завершится, задачу подхватит другой воркер
+    if fcntl is None:
+        return True
+    file = open(os.path.join(LOCK_DIR, _lock_name(func)), 'a')
+    try:
+        fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        file.close()
+        return None
+    return file
+
+
+def every(interval, func, run_now=True, exclusive=False):
+    # exclusive: из нескольких процессов с одной базой задачу выполняет только один
+    def loop():
+        holder = None
+        pending = run_now
+        while pending or not _stop.wait(interval):
+            pending = False
+            if exclusive and holder is None:
+                holder = _acquire(func)
+                if holder is None:
+                    continue
+            _run(func)
+
+    thread = threading.Thread(target=loop, name=f'every-{func.__name__}', daemon=True)
+    thread.start()
+    return thread
+
+
+def _run(func, *args, **kwargs):
+    try:
+        return func(*args, **kwargs)
+    except Exception:
+        logging.exception('Фоновая задача %s завершилась с ошибкой', func.__name__)
+
+
+def stop():
+    _stop.set()
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
@@ -0,0 +1,145 @@
+import logging
+import os
+import shutil
+import subprocess
+import sqlalchemy
+
+from . import db_session, tasks, storage
+from .db_session import SqlAlchemyBase
+from .audio import Audio, READY
+from .files import file_hash
+
+VARIANTS_DIR = 'static/audio/variants'
+ENCODER = os.environ.get('FEEL_FFMPEG') or shutil.which('ffmpeg')
+ORIGINAL = 'original'
+LOW = 'low'
+MEDIUM = 'medium'
+PREVIEW = 'preview'
+BITRATES = {LOW: 64000, MEDIUM: 128000, PREVIEW: 96000}
+PREVIEW_LENGTH = 30
+QUALITIES = (ORIGINAL, LOW, MEDIUM, PREVIEW)
+SLOW_NETWORKS = ('slow-2g', '2g', '3g')
+CLIENT_HINTS = ('Save-Data', 'ECT', 'Downlink')
+
+
+class AudioVariant(SqlAlchemyBase):
+    __tablename__ = 'audio_variants'
+
+    audio_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('audio.id'), primary_key=True)
+    kind = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+    file = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+    file_hash = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+    bitrate = sqlalchemy.Column(sqlalchemy.Integer, nullable=True)
+
+    def __repr__(self):
+        return f'<AudioVariant> {self.audio_id} {self.kind}'
+
+
+def enabled():
+    return bool(ENCODER)
+
+
+def _preview_start(duration):
+    # Фрагмент берётся ближе к середине трека, где обычно уже звучит основная тема
+    if not duration or duration <= PREVIEW_LENGTH:
+        return 0
+    return int(min(duration * 0.3, duration - PREVIEW_LENGTH))
+
+
+def preview_window(duration):
+    # Доля трека, которую занимает фрагмент: по ней из волны оригинала вырезается волна фрагмента
+    if not duration:
+        return 0, 1
+    start = _preview_start(duration)
+    return start / duration, min(start + PREVIEW_LENGTH, duration) / duration
+
+
+def _encode(source, target, bitrate, start=None, length=None):
+    command = [ENCODER, '-nostdin', '-y', '-v', 'error']
+    if start is not None:
+        command += ['-ss', str(start)]
+    command += ['-i', source, '-vn', '-map_metadata', '-1']
+    if length is not None:
+        command += ['-t', str(length), '-af', f'afade=t=in:d=1,afade=t=out:st={length - 2}:d=2']
+    command += ['-codec:a', 'libmp3lame', '-b:a', str(bitrate), target]
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+
+def _variants_for(audio):
+    variants = {PREVIEW: (_preview_start(audio.duration), PREVIEW_LENGTH)}
+    for kind in (LOW, MEDIUM):
+        # Не делаем вариант, который не легче оригинала
+        if not audio.bitrate or BITRATES[kind] < audio.bitrate:
+            variants[kind] = (None, None)
+    return variants
+
+
+def process(audio_id):
+    if not enabled():
+        return
+    db_sess = db_session.create_session()
+    try:
+        audio = db_sess.query(Audio).get(audio_id)
+        if not audio or audio.status != READY:
+            return
+        try:
+            source = storage.local_file(audio.file, audio.file_hash)
+        except OSError as error:
+            logging.warning('Нет файла трека %s для перекодирования: %s', audio_id, error)
+            return
+        os.makedirs(VARIANTS_DIR, exist_ok=True)
+        # Один файл в хранилище могут делить несколько треков, а варианты удаляются вместе с треком
+        stem = f'{audio.id}'
+        for kind, (start, length) in _variants_for(audio).items():
+            target = f'{VARIANTS_DIR}/{stem}_{kind}.mp3'
+            try:
+                _encode(source, target, BITRATES[kind], start, length)
+            except (OSError, subprocess.CalledProcessError) as error:
+                logging.warning('Не удалось перекодировать трек %s в %s: %s', audio_id, kind, error)
+                continue
+            db_sess.merge(AudioVariant(audio_id=audio_id, kind=kind, file=target,
+                                       file_hash=file_hash(target), bitrate=BITRATES[kind]))
+            db_sess.commit()
+    finally:
+        db_sess.close()
+
+
+def advertise_hints(response):
+    # ECT и Downlink браузер присылает только после того, как сервер запросил их через Accept-CH
+    if response.mimetype == 'text/html':
+        response.headers['Accept-CH'] = ', '.join(CLIENT_HINTS)
+    return response
+
+
+def choose_quality(requested, headers):
+    if requested in QUALITIES:
+        return requested
+    # Клиентские подсказки: режим экономии трафика или медленная сеть
+    if headers.get('Save-Data', '').lower() == 'on' or headers.get('ECT', '').lower() in SLOW_NETWORKS:
+        return LOW
+    try:
+        if float(headers.get('Downlink', 'inf')) < 1:
+            return LOW
+    except ValueError:
+        pass
+    return ORIGINAL
+
+
+def variant(db_sess, audio_id, quality):
+    if quality == ORIGINAL:
+        return None
+    return db_sess.query(AudioVariant).filter(
+        AudioVariant.audio_id == audio_id, AudioVariant.kind == quality).first()
+
+
+def backfill():
+    db_sess = db_session.create_session()
+    try:
+        done = {audio_id for audio_id, in db_sess.query(AudioVariant.audio_id).filter(
+            AudioVariant.kind == PREVIEW)}
+        pending = [audio_id for audio_id, in db_sess.query(Audio.id).filter(Audio.status == READY)
+                   if audio_id not in done]
+    finally:
+        db_sess.close()
+    return [tasks.submit(process, audio_id) for audio_id in pending]
+
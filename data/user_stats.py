@@ -0,0 +1,48 @@
+import sqlalchemy
+
+from .audio import Audio, READY, DELETED
+from .users import User
+
+
+def _values(deltas):
+    return {getattr(User, name): getattr(User, name) + delta for name, delta in deltas.items() if delta}
+
+
+def bump(db_sess, user_id, **deltas):
+    # Агрегаты меняются в той же транзакции, что и породившее их действие, и коммитятся вместе с ним
+    values = _values(deltas)
+    if values:
+        db_sess.query(User).filter(User.id == user_id).update(values, synchronize_session=False)
+
+
+def bump_publisher(db_sess, audio_id, **deltas):
+    values = _values(deltas)
+    if values:
+        publisher = db_sess.query(Audio.publisher).filter(Audio.id == audio_id).scalar_subquery()
+        db_sess.query(User).filter(User.id == publisher).update(values, synchronize_session=False)
+
+
+def _expected():
+    def aggregate(column, *criteria):
+        return sqlalchemy.select(sqlalchemy.func.coalesce(column, 0)).where(
+            Audio.publisher == User.id, *criteria).scalar_subquery()
+
+    return {User.track_count: aggregate(sqlalchemy.func.count(Audio.id), Audio.status == READY),
+            User.total_likes: aggregate(sqlalchemy.func.sum(Audio.likes), Audio.status != DELETED),
+            User.total_plays: aggregate(sqlalchemy.func.sum(Audio.plays), Audio.status != DELETED)}
+
+
+def recompute(db_sess):
+    expected = _expected()
+    drift = sqlalchemy.or_(*(column != value for column, value in expected.items()))
+    repaired = db_sess.query(User).filter(drift).update(expected, synchronize_session=False)
+    db_sess.commit()
+    return repaired
+
+
+def migrate_legacy(db_sess):
+    # Колонки агрегатов только что добавлены и заполнены нулями - пересчитываем их один раз
+    stale = db_sess.query(Audio.id).join(User, User.id == Audio.publisher).filter(
+        Audio.status == READY, User.track_count == 0).first()
+    if stale:
+        recompute(db_sess)
@@ -1,5 +1,6 @@
 import datetime
 import sqlalchemy
+from sqlalchemy import orm
 from sqlalchemy_serializer import SerializerMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
@@ -9,6 +10,7 @@ from .db_session import SqlAlchemyBase
 
 class User(SqlAlchemyBase, UserMixin, SerializerMixin):
     __tablename__ = 'users'
+    serialize_rules = ('-audios',)
 
     id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True, autoincrement=True)
     surname = sqlalchemy.Column(sqlalchemy.String, nullable=True)
@@ -17,9 +19,19 @@ class User(SqlAlchemyBase, UserMixin, SerializerMixin):
     email = sqlalchemy.Column(sqlalchemy.String, index=True, unique=True, nullable=True)
     age = sqlalchemy.Column(sqlalchemy.Integer, nullable=True)
     avatar_img = sqlalchemy.Column(sqlalchemy.String, default='/static/img/user.png')
+    # sha256 загруженного файла: миниатюры лежат в static/img/avatars под этим именем
+    avatar_hash = sqlalchemy.Column(sqlalchemy.String, nullable=True)
     hashed_password = sqlalchemy.Column(sqlalchemy.String, nullable=True)
     modified_date = sqlalchemy.Column(sqlalchemy.DateTime, default=datetime.datetime.now)
     register_date = sqlalchemy.Column(sqlalchemy.DateTime, default=datetime.datetime.now)
+    version = sqlalchemy.Column(sqlalchemy.Integer, default=0, server_default='0', nullable=False)
+    # Агрегаты для профиля поддерживаются обработчиками, расхождения чинит manage.py recompute-stats
+    track_count = sqlalchemy.Column(sqlalchemy.Integer, default=0, server_default='0', nullable=False)
+    total_likes = sqlalchemy.Column(sqlalchemy.Integer, default=0, server_default='0', nullable=False)
+    total_plays = sqlalchemy.Column(sqlalchemy.Integer, default=0, server_default='0', nullable=False)
+    followers_count = sqlalchemy.Column(sqlalchemy.Integer, default=0, server_default='0', nullable=False)
+    following_count = sqlalchemy.Column(sqlalchemy.Integer, default=0, server_default='0', nullable=False)
+    audios = orm.relation('Audio', back_populates='user')
 
     def __repr__(self):
         return f'<User> {self.id} {self.name} {self.email}'
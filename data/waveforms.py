@@ -0,0 +1,135 @@
+import hashlib
+import math
+import subprocess
+import sqlalchemy
+from flask import make_response, abort, request
+
+from . import db_session, transcode, storage
+from .streaming import VERSION_LENGTH, is_current
+from .db_session import SqlAlchemyBase
+from .audio import Audio, READY, DELETED
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+BINS = 800
+SAMPLE_RATE = 8000
+MAX_AGE = 365 * 24 * 60 * 60
+
+
+class Waveform(SqlAlchemyBase):
+    __tablename__ = 'waveforms'
+
+    audio_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('audio.id'), primary_key=True)
+    bins = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    # Пары (min, max) в int8 подряд: 2 байта на столбик, ~1.6 КБ на трек
+    peaks = sqlalchemy.Column(sqlalchemy.LargeBinary, nullable=False)
+
+    def __repr__(self):
+        return f'<Waveform> {self.audio_id} {self.bins}'
+
+
+def enabled():
+    return numpy is not None and transcode.enabled()
+
+
+def _decode(path):
+    # ffmpeg декодирует MP3 в моно 16-битный PCM с низкой частотой - для пиков этого достаточно
+    command = [transcode.ENCODER, '-nostdin', '-v', 'error', '-i', path,
+               '-ac', '1', '-ar', str(SAMPLE_RATE), '-f', 's16le', '-']
+    result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return numpy.frombuffer(result.stdout, dtype=numpy.int16)
+
+
+def compute_peaks(path, bins=BINS):
+    samples = _decode(path)
+    if samples.size == 0:
+        return numpy.zeros(bins * 2, dtype=numpy.int8).tobytes()
+    if samples.size < bins:
+        samples = numpy.pad(samples, (0, bins - samples.size))
+    usable = samples[:samples.size - samples.size % bins].reshape(bins, -1)
+    peaks = numpy.empty((bins, 2), dtype=numpy.int8)
+    peaks[:, 0] = usable.min(axis=1) >> 8
+    peaks[:, 1] = usable.max(axis=1) >> 8
+    return peaks.tobytes()
+
+
+def save(db_sess, audio_id, peaks, bins=BINS):
+    db_sess.merge(Waveform(audio_id=audio_id, bins=bins, peaks=peaks))
+    # Новая версия сбрасывает кэшированные карточки, отрисованные ещё без волны
+    db_sess.query(Audio).filter(Audio.id == audio_id).update(
+        {Audio.has_waveform: True, Audio.version: Audio.version + 1}, synchronize_session=False)
+    db_sess.commit()
+
+
+def process(audio_id):
+    if not enabled():
+        return
+    db_sess = db_session.create_session()
+    try:
+        audio = db_sess.query(Audio).get(audio_id)
+        if not audio or audio.status != READY:
+            return
+        save(db_sess, audio_id, compute_peaks(storage.local_file(audio.file, audio.file_hash)))
+    finally:
+        db_sess.close()
+
+
+def pending(db_sess):
+    return db_sess.query(Audio.id, Audio.file, Audio.file_hash).outerjoin(
+        Waveform, Waveform.audio_id == Audio.id).filter(
+        Audio.status == READY, Waveform.audio_id.is_(None)).all()
+
+
+def waveform_url(audio, quality=None):
+    if not audio.has_waveform:
+        return None
+    params = []
+    if audio.file_hash:
+        params.append(f'v={audio.file_hash[:VERSION_LENGTH]}')
+    if quality:
+        params.append(f'q={quality}')
+    return f'/waveform/{audio.id}' + ('?' + '&'.join(params) if params else '')
+
+
+def migrate_legacy(db_sess):
+    # Волны, рассчитанные до появления флага has_waveform
+    computed = db_sess.query(Waveform.audio_id).scalar_subquery()
+    if db_sess.query(Audio).filter(Audio.id.in_(computed), Audio.has_waveform.is_(False)).update(
+            {Audio.has_waveform: True, Audio.version: Audio.version + 1}, synchronize_session=False):
+        db_sess.commit()
+
+
+def _window(peaks, start, end):
+    # Волна хранится парами (минимум, максимум) на равные отрезки всего трека
+    bins = len(peaks) // 2
+    first = int(start * bins)
+    last = min(max(first + 1, math.ceil(end * bins)), bins)
+    return peaks[2 * first:2 * last]
+
+
+def send(db_sess, audio_id, version=None, quality=None):
+    found = db_sess.query(Waveform.peaks, Audio.file_hash, Audio.duration).join(
+        Audio, Audio.id == Waveform.audio_id).filter(
+        Waveform.audio_id == audio_id, Audio.status != DELETED).first()
+    if not found:
+        abort(404)
+    peaks, immutable = found.peaks, is_current(found.file_hash, version)
+    if quality == transcode.PREVIEW:
+        # Плеер ленты играет фрагмент, если он уже готов, иначе оригинал - волна должна совпадать с ним
+        if transcode.variant(db_sess, audio_id, transcode.PREVIEW):
+            peaks = _window(peaks, *transcode.preview_window(found.duration))
+        else:
+            immutable = False
+    response = make_response(peaks)
+    response.mimetype = 'application/octet-stream'
+    response.set_etag(hashlib.md5(peaks).hexdigest())
+    response.cache_control.public = True
+    if immutable:
+        response.cache_control.max_age = MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response.make_conditional(request)
@@ -1,13 +1,13 @@
 from flask_wtf import FlaskForm
 from wtforms import SubmitField, StringField
 from flask_wtf.file import FileField, FileRequired, FileAllowed
-from wtforms.validators import DataRequired
+from wtforms.validators import Optional
 
 
 class PublishForm(FlaskForm):
-    author = StringField("Автор композиции", validators=[DataRequired()])
-    name = StringField("Название", validators=[DataRequired()])
-    genre = StringField("Жанр", validators=[DataRequired()])
+    author = StringField("Автор композиции", validators=[Optional()])
+    name = StringField("Название", validators=[Optional()])
+    genre = StringField("Жанр", validators=[Optional()])
     file = FileField("Файл композиции",
                      validators=[FileRequired(), FileAllowed(['mp3'],
                                                              'Для загрузки допускаются только аудиофайлы формата MP3')])
@@ -0,0 +1,48 @@
+# Запуск: gunicorn -c gunicorn.conf.py wsgi:app
+# Мастер один раз импортирует приложение и инициализирует базу, затем форкает воркеры с потоками
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+bind = os.environ.get('FEEL_BIND', f"0.0.0.0:{os.environ.get('PORT', 8000)}")
+workers = int(os.environ.get('FEEL_WORKERS', multiprocessing.cpu_count()))
+# Каждое WebSocket-соединение /live занимает поток воркера на всё время подключения,
+# поэтому их не больше FEEL_LIVE_CONNECTIONS на воркер
+threads = int(os.environ.get('FEEL_THREADS', 16))
+worker_class = 'gthread'
+preload_app = True
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+
+# Задаётся до импорта приложения (preload_app): метрики воркеров складываются через общий каталог.
+# pid мастера не меняется и при перечитывании конфигурации по HUP
+METRICS_DIR = os.path.join(tempfile.gettempdir(), f'feel-metrics-{os.getpid()}')
+os.environ.setdefault('FEEL_METRICS_DIR', METRICS_DIR)
+
+
+def on_starting(server):
+    from data import metrics
+    metrics.reset()
+
+
+def when_ready(server):
+    # Соединения, открытые мастером при инициализации, не должны достаться воркерам после fork
+    from data import db_session
+    db_session.get_engine().dispose()
+
+
+def post_worker_init(worker):
+    import main
+    main.start_jobs()
+
+
+def worker_exit(server, worker):
+    import main
+    main.stop_jobs()
+
+
+def on_exit(server):
+    if os.environ['FEEL_METRICS_DIR'] == METRICS_DIR:
+        shutil.rmtree(METRICS_DIR, ignore_errors=True)
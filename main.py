@@ -1,97 +1,182 @@
-import os
-
-from flask import Flask, render_template, redirect, request, abort
+import sqlalchemy
+from flask import Blueprint, Flask, render_template, redirect, request, abort, make_response, jsonify
 from flask_login import LoginManager, login_required, logout_user, login_user, current_user
-from werkzeug.utils import secure_filename
 from flask_restful import Api
-
-import datetime as dt
-from mutagen.mp3 import MP3
+from flask_sock import Sock
 
 from forms.user_forms import RegisterForm, LoginForm, EditInfoForm
 from forms.audio_forms import PublishForm
 from data.users import User
-from data.audio import Audio
-from data import db_session, api_file
+from data.audio import Audio, DELETED
+from data import db_session, api_file, reactions, feed, search, charts, tasks, streaming, ingest, transcode
+from data import waveforms, sweeper, fragments, live, avatars, metrics, plays, recommendations, events
+from data import comments as comment_store
 
 
-app = Flask(__name__)
-api = Api(app)
-app.config['SECRET_KEY'] = 'yandexlyceum_secret_key'
+pages = Blueprint('pages', __name__)
+api = Api(pages)
+sock = Sock()
 login_manager = LoginManager()
-login_manager.init_app(app)
+api.add_resource(api_file.UserListResource, '/api/users')
+api.add_resource(api_file.UserResource, '/api/users/<int:user_id>')
+api.add_resource(api_file.AudioListResource, '/api/audios')
+api.add_resource(api_file.AudioResource, '/api/audios/<int:audio_id>')
+DB_FILE = 'db/dataB.db'
 roles = {'0': 'Администратор', '1': 'Модератор',
          '2': 'Слушатель', '3': 'Музыкант'}
 
 
+def create_app(db_file=DB_FILE):
+    # Под gunicorn вызывается один раз в мастере (preload_app), воркеры получают готовое приложение.
+    # Каждый вызов создаёт новое приложение, но база у процесса одна: другая база - ошибка global_init
+    db_session.global_init(db_file)
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = 'yandexlyceum_secret_key'
+    login_manager.init_app(app)
+    db_session.init_app(app)
+    metrics.init_app(app)
+    app.after_request(transcode.advertise_hints)
+    app.jinja_env.globals['avatar_url'] = avatars.url
+    app.register_blueprint(pages)
+    sock.init_app(app)
+    return app
+
+
+def start_jobs():
+    # Буфер прослушиваний у каждого процесса свой, а общие задачи берёт на себя один из воркеров;
+    # журнал событий опрашивает каждый процесс, чтобы обновлять своих подписчиков и свой кэш чартов
+    tasks.every(events.POLL_INTERVAL, events.poll_job)
+    tasks.every(events.PRUNE_INTERVAL, events.prune_job, exclusive=True)
+    if metrics.MULTIPROCESS_DIR:
+        tasks.every(metrics.DUMP_INTERVAL, metrics.dump, run_now=False)
+    tasks.every(charts.REFRESH_INTERVAL, charts.refresh_job, exclusive=True)
+    tasks.every(sweeper.SWEEP_INTERVAL, sweeper.sweep_job, exclusive=True)
+    tasks.every(ingest.REQUEUE_INTERVAL, ingest.requeue_job, exclusive=True)
+    tasks.every(recommendations.REFRESH_INTERVAL, recommendations.refresh_job, exclusive=True)
+    tasks.every(recommendations.FULL_REFRESH_INTERVAL, recommendations.full_refresh_job, run_now=False, exclusive=True)
+    tasks.every(plays.FLUSH_INTERVAL, plays.flush_job, run_now=False)
+
+
+def stop_jobs():
+    tasks.stop()
+    plays.flush()
+    events.flush()
+    metrics.dump()
+
+
 def main():
-    db_session.global_init("db/dataB.db")
-    api.add_resource(api_file.UserListResource, '/api/users')
-    api.add_resource(api_file.UserResource, '/api/users/<int:user_id>')
-    api.add_resource(api_file.AudioListResource, '/api/audios')
-    api.add_resource(api_file.AudioResource, '/api/audios/<int:audio_id>')
-    app.run()
+    app = create_app()
+    start_jobs()
+    try:
+        app.run()
+    finally:
+        stop_jobs()
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    db_sess = db_session.create_session()
+    db_sess = db_session.request_session()
     return db_sess.query(User).get(user_id)
 
 
-@app.route('/logout')
+def _current_user_id():
+    return current_user.id if current_user.is_authenticated else None
+
+
+@pages.route('/logout')
 @login_required
 def logout():
     logout_user()
     return redirect("/main")
 
 
-@app.route('/')
-@app.route('/title')
+@pages.route('/')
+@pages.route('/title')
 def index():
-    db_sess = db_session.create_session()
-    auds = db_sess.query(Audio).all()
-    auds = sorted(auds, key=lambda x: x.likes, reverse=True)
-    auds = [auds[i] for i in range(5 if len(auds) >= 5 else len(auds))]
-    pop_auds = []
-    for audio in auds:
-        pop_auds.append([audio.name, audio.file, audio.likes])
-    for i in range(len(pop_auds)):
-        pop_auds[i].append(i)
-    return render_template('title.html', popular_audios=pop_auds, pop_len=len(pop_auds))
-
-
-@app.route('/main/')
-@app.route('/main/<search_value>')
+    db_sess = db_session.request_session()
+    window = request.args.get('window', charts.ALL_TIME)
+    if window not in (charts.ALL_TIME, charts.TRENDING) and window not in charts.WINDOWS:
+        abort(404)
+    pop_auds = [audio + [i] for i, audio in enumerate(charts.top(db_sess, window))]
+    return render_template('title.html', popular_audios=pop_auds, pop_len=len(pop_auds), window=window)
+
+
+@pages.route('/main/')
+@pages.route('/main/<search_value>')
 def site_main(search_value=None):
-    db_sess = db_session.create_session()
-    audios = []
-    if search_value:
-        g_auds = db_sess.query(Audio).filter(Audio.name.like(f'%{search_value.lower().strip()}%')).all()
-    else:
-        g_auds = db_sess.query(Audio).all()
+    db_sess = db_session.request_session()
+    g_auds, next_cursor = feed.page(db_sess, request.args.get('cursor'), search_value)
+    return render_template('main.html', cards=_feed_cards(db_sess, g_auds), next_cursor=next_cursor,
+                           search_value=(search_value if search_value else ''))
+
+
+@pages.route('/feed/page')
+def feed_page():
+    db_sess = db_session.request_session()
+    search_value = request.args.get('q')
+    g_auds, next_cursor = feed.page(db_sess, request.args.get('cursor'), search_value)
+    response = make_response(render_template('audio_cards.html', cards=_feed_cards(db_sess, g_auds)))
+    response.headers['X-Next-Cursor'] = next_cursor or ''
+    return response
+
+
+@pages.route('/metrics')
+def metrics_page():
+    return metrics.response()
+
+
+@pages.route('/healthz')
+def healthz():
+    return 'ok'
+
+
+@pages.route('/readyz')
+def readyz():
+    try:
+        db_session.request_session().execute(sqlalchemy.text('SELECT 1'))
+    except sqlalchemy.exc.SQLAlchemyError:
+        return 'database unavailable', 503
+    return 'ok'
+
+
+@pages.route('/search/suggest')
+def search_suggest():
+    db_sess = db_session.request_session()
+    return jsonify({'suggestions': search.suggest(db_sess, request.args.get('q', ''))})
+
+
+def _can_moderate(owner_id):
+    return current_user.is_authenticated and (current_user.id == owner_id or current_user.role in ('0', '1'))
+
+
+def _feed_card(audio):
+    publisher_name = audio.user.surname + ' ' + audio.user.name
+    publisher_avatar = avatars.url(audio.user)
+    return [audio.publisher, audio.author,
+            streaming.audio_url(audio.id, audio.file_hash, transcode.PREVIEW), audio.name,
+            audio.genre, publisher_name, audio.id, audio.likes, audio.dislikes,
+            publisher_avatar, audio.comments_count, waveforms.waveform_url(audio, transcode.PREVIEW)]
+
+
+def _feed_cards(db_sess, g_auds):
+    cards = []
+    user_reactions = reactions.user_reactions(db_sess, _current_user_id(), (audio.id for audio in g_auds))
     for audio in g_auds:
-        publisher = db_sess.query(User).filter(User.id == audio.publisher).first()
-        publisher_name = publisher.surname + ' ' + publisher.name
-        publisher_avatar = publisher.avatar_img
-        audio_likers = map(int, audio.likers.split()) if audio.likers else []
-        audio_dislikers = map(int, audio.dislikers.split()) if audio.dislikers else []
-        comments_sum = len(audio.comments.split('✓')) if audio.comments != '' else 0
-        audios.append([audio.publisher, audio.author, audio.file, audio.name,
-                       audio.genre, publisher_name, audio.id, audio.likes,
-                       audio.dislikes, audio_likers, audio_dislikers, publisher_avatar,
-                       comments_sum])
-    return render_template('main.html', audios=reversed(audios), search_value=(search_value if search_value else ''))
-
-
-@app.route('/register', methods=['GET', 'POST'])
+        reaction = user_reactions.get(audio.id)
+        html = fragments.render(fragments.FEED, audio, audio.user, lambda: {'audio': _feed_card(audio)})
+        cards.append(fragments.personalize(html, reaction == reactions.LIKE, reaction == reactions.DISLIKE,
+                                           _can_moderate(audio.publisher)))
+    return cards
+
+
+@pages.route('/register', methods=['GET', 'POST'])
 def register():
     form = RegisterForm()
     if form.validate_on_submit():
         if form.password.data != form.repeat_password.data:
             return render_template('register.html', title='Регистрация', form=form,
                                    message="Пароли не совпадают!")
-        db_sess = db_session.create_session()
+        db_sess = db_session.request_session()
         if db_sess.query(User).filter(User.email == form.email.data).first():
             return render_template('register.html', title='Регистрация', form=form,
                                    message="Такой пользователь уже зарегистрирован!")
@@ -103,22 +188,19 @@ def register():
             role=form.role.data
         )
         user.set_password(form.password.data)
-        if form.avatar_img.data:
-            file = form.avatar_img.data
-            filename = secure_filename(file.filename)
-            file.save(os.path.join('static/img/users_profiles/', filename))
-            user.avatar_img = f'/static/img/users_profiles/{filename}'
         db_sess.add(user)
         db_sess.commit()
+        if form.avatar_img.data:
+            avatars.publish(user.id, *avatars.save(form.avatar_img.data))
         return redirect('/login')
     return render_template('register.html', form=form, mode='register')
 
 
-@app.route('/login', methods=['GET', 'POST'])
+@pages.route('/login', methods=['GET', 'POST'])
 def login():
     form = LoginForm()
     if form.validate_on_submit():
-        db_sess = db_session.create_session()
+        db_sess = db_session.request_session()
         user = db_sess.query(User).filter(User.email == form.email.data).first()
         if user and user.check_password(form.password.data):
             login_user(user, remember=form.remember_me.data)
@@ -129,111 +211,121 @@ def login():
     return render_template('login.html', form=form, mode='register')
 
 
-@app.route('/publish',  methods=['GET', 'POST'])
+@pages.route('/publish',  methods=['GET', 'POST'])
 @login_required
 def publish():
     form = PublishForm()
     if form.validate_on_submit():
-        db_sess = db_session.create_session()
-        file = form.file.data
-        file.filename = f'{len(db_sess.query(Audio).all()) + 1}.mp3'
-        filename = secure_filename(file.filename)
-        file.save(os.path.join('static/audio', filename))
-        audio = Audio(
-            publisher=current_user.id,
-            author=form.author.data,
-            name=form.name.data,
-            genre=form.genre.data,
-            file=f'static/audio/{filename}',
-            publish_date=dt.datetime.now(),
-        )
-        audio.duration = MP3(audio.file).info.length
-        db_sess.add(audio)
-        db_sess.commit()
-        return redirect('/main')
+        db_sess = db_session.request_session()
+        ingest.publish(db_sess, current_user.id, form.file.data,
+                       author=form.author.data, name=form.name.data, genre=form.genre.data)
+        return redirect(f'/user/{current_user.id}')
     return render_template('audio_x.html', form=form)
 
 
-@app.route('/like/<data>', methods=['GET', 'POST'])
+@pages.route('/stream/<int:audio_id>')
+def stream_audio(audio_id):
+    db_sess = db_session.request_session()
+    return streaming.send_audio(db_sess, audio_id, request.args.get('v'), request.args.get('q'), request.headers)
+
+
+@pages.route('/avatars/<name>')
+def avatar(name):
+    return avatars.send(name)
+
+
+@pages.route('/waveform/<int:audio_id>')
+def waveform(audio_id):
+    db_sess = db_session.request_session()
+    return waveforms.send(db_sess, audio_id, request.args.get('v'), request.args.get('q'))
+
+
+@pages.route('/like/<data>', methods=['GET', 'POST'])
 @login_required
 def like(data):
-    audio_id, prev_url = data.split(None, 1)
-    audio_id = int(audio_id)
-    prev_url = '/'.join(prev_url.split())
-    db_sess = db_session.create_session()
-    audio = db_sess.query(Audio).filter(Audio.id == audio_id).first()
-    audio_likers = audio.likers.split() if audio.likers else []
-    audio_dislikers = audio.dislikers.split() if audio.dislikers else []
-    if audio:
-        if str(current_user.id) not in audio_likers:
-            audio.likes += 1
-            audio_likers.append(str(current_user.id))
-            if str(current_user.id) in audio_dislikers:
-                audio.dislikes -= 1
-                del audio_dislikers[audio_dislikers.index(str(current_user.id))]
-        else:
-            audio.likes -= 1
-            del audio_likers[audio_likers.index(str(current_user.id))]
-        audio.likers = ' '.join(audio_likers)
-        audio.dislikers = ' '.join(audio_dislikers)
-        db_sess.commit()
-    else:
-        abort(404)
-    return redirect(f'/{prev_url}')
+    return _react(data, reactions.LIKE)
 
 
-@app.route('/dislike/<data>', methods=['GET', 'POST'])
+@pages.route('/dislike/<data>', methods=['GET', 'POST'])
 @login_required
 def dislike(data):
+    return _react(data, reactions.DISLIKE)
+
+
+def _react(data, value):
     audio_id, prev_url = data.split(None, 1)
-    audio_id = int(audio_id)
     prev_url = '/'.join(prev_url.split())
-    db_sess = db_session.create_session()
-    audio = db_sess.query(Audio).filter(Audio.id == audio_id).first()
-    audio_likers = audio.likers.split() if audio.likers else []
-    audio_dislikers = audio.dislikers.split() if audio.dislikers else []
-    if audio:
-        if str(current_user.id) not in audio_dislikers:
-            audio.dislikes += 1
-            audio_dislikers.append(str(current_user.id))
-            if str(current_user.id) in audio_likers:
-                audio.likes -= 1
-                del audio_likers[audio_likers.index(str(current_user.id))]
-        else:
-            audio.dislikes -= 1
-            del audio_dislikers[audio_dislikers.index(str(current_user.id))]
-        audio.likers = ' '.join(audio_likers)
-        audio.dislikers = ' '.join(audio_dislikers)
-        db_sess.commit()
-    else:
-        abort(404)
+    _apply_reaction(db_session.request_session(), int(audio_id), value)
     return redirect(f'/{prev_url}')
 
 
-@app.route('/user/<int:user_id>')
+def _apply_reaction(db_sess, audio_id, value):
+    if not db_sess.query(Audio.id).filter(Audio.id == audio_id, Audio.status != DELETED).first():
+        abort(404)
+    current = reactions.toggle(db_sess, audio_id, current_user.id, value)
+    charts.invalidate()
+    fragments.invalidate(audio_id)
+    likes, dislikes = db_sess.query(Audio.likes, Audio.dislikes).filter(Audio.id == audio_id).one()
+    event = live.reaction_event(audio_id, likes, dislikes)
+    live.broadcast_coalesced(event)
+    return current, event
+
+
+@pages.route('/react/<int:audio_id>', methods=['POST'])
+@login_required
+def react(audio_id):
+    value = {'like': reactions.LIKE, 'dislike': reactions.DISLIKE}.get(request.form.get('value'))
+    if value is None:
+        abort(400)
+    current, event = _apply_reaction(db_session.request_session(), audio_id, value)
+    return jsonify(dict(event, value={reactions.LIKE: 'like', reactions.DISLIKE: 'dislike'}.get(current, '')))
+
+
+@pages.route('/play/<int:audio_id>', methods=['POST'])
+def play(audio_id):
+    # Без обращения к базе: несуществующие и удалённые треки отсеются при сбросе буфера
+    plays.record(audio_id)
+    return '', 204
+
+
+@sock.route('/live', bp=pages)
+def live_updates(ws):
+    live.serve(ws, live.query_ids(request.args.get('ids', '')))
+
+
+def _profile_card(audio):
+    return [audio.author, streaming.audio_url(audio.id, audio.file_hash), audio.name, audio.genre, audio.id,
+            audio.likes, audio.dislikes, audio.comments_count, audio.status, waveforms.waveform_url(audio)]
+
+
+@pages.route('/user/<int:user_id>')
 def user_prof(user_id):
-    db_sess = db_session.create_session()
-    user = db_sess.query(User).filter(User.id == user_id).first()
+    db_sess = db_session.request_session()
+    user = db_sess.query(User).get(user_id)
+    if not user:
+        abort(404)
     user_audios = []
-    for audio in db_sess.query(Audio).filter(Audio.publisher == user_id).all():
-        audio_likers = map(int, audio.likers.split()) if audio.likers else []
-        audio_dislikers = map(int, audio.dislikers.split()) if audio.dislikers else []
-        comments_sum = len(audio.comments.split('✓')) if audio.comments != '' else 0
-        user_audios.append([audio.author, audio.file, audio.name, audio.genre, audio.id,
-                            audio.likes, audio.dislikes, audio_likers, audio_dislikers,
-                            comments_sum])
-    for i in range(len(user_audios)):
-        user_audios[i].append(i)
+    g_auds, next_cursor = feed.user_page(db_sess, user_id, request.args.get('cursor'),
+                                         include_hidden=_current_user_id() == user_id)
+    user_reactions = reactions.user_reactions(db_sess, _current_user_id(), (audio.id for audio in g_auds))
+    for audio in g_auds:
+        reaction = user_reactions.get(audio.id)
+        html = fragments.render(fragments.PROFILE, audio, user, lambda: {
+            'audio': _profile_card(audio), 'publisher_id': user.id})
+        user_audios.append(fragments.personalize(html, reaction == reactions.LIKE, reaction == reactions.DISLIKE,
+                                                 _can_moderate(user.id)))
     user_role = roles[user.role]
-    user_info = [user.surname, user.name, user_role, user.age, user.avatar_img, user.id, len(user_audios)]
-    return render_template('user.html', user_info=user_info, user_audios=user_audios)
+    user_info = [user.surname, user.name, user_role, user.age, avatars.url(user, avatars.LARGE), user.id,
+                 user.track_count, user.total_likes, user.total_plays]
+    return render_template('user.html', user_info=user_info, user_audios=user_audios, next_cursor=next_cursor,
+                           similar_tracks=recommendations.for_publisher(db_sess, user.id))
 
 
-@app.route('/user/<int:user_id>/edit', methods=['GET', 'POST'])
+@pages.route('/user/<int:user_id>/edit', methods=['GET', 'POST'])
 def user_edit(user_id):
     form = EditInfoForm()
     if request.method == "GET":
-        db_sess = db_session.create_session()
+        db_sess = db_session.request_session()
         user = db_sess.query(User).filter(User.id == user_id).first()
         if user:
             form.email.data = user.email
@@ -244,20 +336,20 @@ def user_edit(user_id):
         else:
             abort(404)
     if form.validate_on_submit():
-        db_sess = db_session.create_session()
+        db_sess = db_session.request_session()
         user = db_sess.query(User).filter(User.id == user_id).first()
         if user:
             user.email = form.email.data
             if form.avatar_img.data:
-                file = form.avatar_img.data
-                filename = secure_filename(file.filename)
-                file.save(os.path.join('static/img/users_profiles/', filename))
-                user.avatar_img = f'/static/img/users_profiles/{filename}'
+                avatars.publish(user.id, *avatars.save(form.avatar_img.data))
             user.surname = form.surname.data
             user.name = form.name.data
             user.age = form.age.data
             user.role = form.role.data
+            user.version = User.version + 1
             db_sess.commit()
+            fragments.invalidate(*[audio_id for audio_id, in db_sess.query(Audio.id).filter(
+                Audio.publisher == user_id)])
             return redirect(f'/user/{user_id}')
         else:
             abort(404)
@@ -266,70 +358,90 @@ def user_edit(user_id):
                            form=form, mode='edit')
 
 
-@app.route('/delete_audio/<data>', methods=['GET', 'POST'])
+@pages.route('/delete_audio/<data>', methods=['GET', 'POST'])
 def delete_audio(data):
     audio_id, prev_url = data.split(None, 1)
     audio_id = int(audio_id)
     prev_url = '/'.join(prev_url.split())
-    db_sess = db_session.create_session()
-    audio = db_sess.query(Audio).filter(Audio.id == audio_id).first()
-    if audio:
-        db_sess.delete(audio)
-        os.remove(audio.file)
-        audios = db_sess.query(Audio).all()
-        for audio in audios:
-            audio.id = audios.index(audio) + 1
-            db_sess.commit()
-        db_sess.commit()
-    else:
+    db_sess = db_session.request_session()
+    if not sweeper.tombstone(db_sess, audio_id):
         abort(404)
+    charts.invalidate()
+    fragments.invalidate(audio_id)
     return redirect(f'/{prev_url}')
 
 
-@app.route('/comments/<int:audio_id>')
+@pages.route('/comments/<int:audio_id>')
 def comments(audio_id):
-    db_sess = db_session.create_session()
-    audio = db_sess.query(Audio).filter(Audio.id == audio_id).first()
+    db_sess = db_session.request_session()
+    audio = db_sess.query(Audio).filter(Audio.id == audio_id, Audio.status != DELETED).first()
+    if not audio:
+        abort(404)
+    page, next_cursor = comment_store.page(db_sess, audio_id, request.args.get('before'))
+    commentator_ids = {comment.user_id for comment in page}
+    commentators = {user.id: user for user in db_sess.query(User).filter(User.id.in_(commentator_ids))}
     audio_comments = []
-    if audio.comments:
-        for comment_data in audio.comments.split('✓'):
-            commentator_id, comment_text, comment_date = comment_data.replace('[', '').replace(']', '').split('Ø', 2)
-            commentator = db_sess.query(User).filter(User.id == commentator_id).first()
-            comment_id = audio.comments.split('✓').index(comment_data)
-            audio_comments.append([commentator, comment_text, comment_date, comment_id])
+    for comment in page:
+        audio_comments.append([commentators.get(comment.user_id), comment.text,
+                               comment.created_at.strftime(comment_store.DATE_FORMAT), comment.id])
     publisher = db_sess.query(User).filter(User.id == audio.publisher).first()
     publisher_name = publisher.surname + ' ' + publisher.name
-    publisher_avatar = publisher.avatar_img
-    audio_likers = map(int, audio.likers.split()) if audio.likers else []
-    audio_dislikers = map(int, audio.dislikers.split()) if audio.dislikers else []
-    audio_info = [audio.publisher, audio.author, audio.file, audio.name,
-                  audio.genre, publisher_name, audio.id, audio.likes,
-                  audio.dislikes, audio_likers, audio_dislikers, publisher_avatar]
-    return render_template('comments.html', audio=audio_info, audio_comments=reversed(audio_comments))
+    publisher_avatar = avatars.url(publisher)
+    reaction = reactions.user_reactions(db_sess, _current_user_id(), [audio.id]).get(audio.id)
+    audio_info = [audio.publisher, audio.author, streaming.audio_url(audio.id, audio.file_hash), audio.name,
+                  audio.genre, publisher_name, audio.id, audio.likes, audio.dislikes, publisher_avatar]
+    html = fragments.render(fragments.COMMENTS, audio, publisher, lambda: {'audio': audio_info})
+    card = fragments.personalize(html, reaction == reactions.LIKE, reaction == reactions.DISLIKE)
+    return render_template('comments.html', audio=audio_info, card=card, audio_comments=audio_comments,
+                           next_cursor=next_cursor, can_moderate=_can_moderate(audio.publisher),
+                           similar_tracks=recommendations.similar(db_sess, audio.id))
+
 
+def _comment_json(comment, user):
+    return {'id': comment.id, 'user_id': user.id, 'author': user.surname + ' ' + user.name,
+            'avatar': avatars.url(user), 'text': comment.text,
+            'created_at': comment.created_at.strftime(comment_store.DATE_FORMAT)}
 
-@app.route('/comment_send/<data>')
+
+def _publish_comment(db_sess, audio_id, comment=None, comment_id=None):
+    fragments.invalidate(audio_id)
+    comments_count = db_sess.query(Audio.comments_count).filter(Audio.id == audio_id).scalar()
+    live.broadcast(live.comment_event(audio_id, comments_count, comment, comment_id))
+
+
+@pages.route('/comment_send/<data>')
 def comment_send(data):
     audio_id, commentator_id, comment_text = data.split(None, 2)
-    db_sess = db_session.create_session()
-    audio = db_sess.query(Audio).filter(Audio.id == audio_id).first()
-    if audio.comments:
-        audio.comments += f'✓[{commentator_id}Ø{comment_text}Ø{dt.datetime.now().strftime("%d/%m/%Y %H:%M")}]'
-    else:
-        audio.comments += f'[{commentator_id}Ø{comment_text}Ø{dt.datetime.now().strftime("%d/%m/%Y %H:%M")}]'
-    db_sess.commit()
+    db_sess = db_session.request_session()
+    if not db_sess.query(Audio.id).filter(Audio.id == audio_id, Audio.status != DELETED).first():
+        abort(404)
+    comment = comment_store.add(db_sess, int(audio_id), int(commentator_id), comment_text)
+    commentator = db_sess.query(User).get(int(commentator_id))
+    _publish_comment(db_sess, int(audio_id), _comment_json(comment, commentator))
     return redirect(f'/comments/{audio_id}')
 
 
-@app.route('/delete_comment/<data>')
+@pages.route('/comments/<int:audio_id>/send', methods=['POST'])
+@login_required
+def comment_post(audio_id):
+    comment_text = request.form.get('text', '').strip()
+    if not comment_text:
+        abort(400)
+    db_sess = db_session.request_session()
+    if not db_sess.query(Audio.id).filter(Audio.id == audio_id, Audio.status != DELETED).first():
+        abort(404)
+    comment = _comment_json(comment_store.add(db_sess, audio_id, current_user.id, comment_text), current_user)
+    _publish_comment(db_sess, audio_id, comment)
+    return jsonify({'comment': comment})
+
+
+@pages.route('/delete_comment/<data>')
 def delete_comment(data):
     comment_id, audio_id = data.split()
-    db_sess = db_session.create_session()
-    audio = db_sess.query(Audio).filter(Audio.id == audio_id).first()
-    audio_comments = audio.comments.split('✓')
-    del audio_comments[int(comment_id)]
-    audio.comments = '✓'.join(audio_comments)
-    db_sess.commit()
+    db_sess = db_session.request_session()
+    if not comment_store.delete(db_sess, int(comment_id), int(audio_id)):
+        abort(404)
+    _publish_comment(db_sess, int(audio_id), comment_id=int(comment_id))
     return redirect(f'/comments/{audio_id}')
 
 
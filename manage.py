@@ -0,0 +1,108 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from data import db_session, transcode, waveforms, avatars, user_stats, plays, storage, recommendations
+
+DB_FILE = 'db/dataB.db'
+
+
+def transcode_command(args):
+    if not transcode.enabled():
+        raise SystemExit('ffmpeg не найден: установите его или укажите путь в FEEL_FFMPEG')
+    futures = transcode.backfill()
+    for future in futures:
+        future.result()
+    print(f'Обработано треков: {len(futures)}')
+
+
+def waveforms_command(args):
+    if not waveforms.enabled():
+        raise SystemExit('Для расчёта волн нужны numpy и ffmpeg')
+    db_sess = db_session.create_session()
+    pending = waveforms.pending(db_sess)
+    done = 0
+    # Декодирование упирается в процессор, поэтому треки раскидываются по процессам
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {}
+        for audio_id, path, content_hash in pending:
+            try:
+                # Объекты из хранилища скачиваются здесь, процессы пула получают только локальные пути
+                path = storage.local_file(path, content_hash)
+            except OSError as error:
+                print(f'Трек {audio_id}: {error}')
+                continue
+            futures[pool.submit(waveforms.compute_peaks, path)] = audio_id
+        for future in as_completed(futures):
+            try:
+                waveforms.save(db_sess, futures[future], future.result())
+                done += 1
+            except Exception as error:
+                print(f'Трек {futures[future]}: {error}')
+    db_sess.close()
+    print(f'Рассчитано волн: {done} из {len(pending)}')
+
+
+def avatars_command(args):
+    done, total = avatars.backfill()
+    print(f'Обработано аватаров: {done} из {total}')
+
+
+def recompute_stats_command(args):
+    db_sess = db_session.create_session()
+    repaired = user_stats.recompute(db_sess)
+    db_sess.close()
+    print(f'Исправлено профилей: {repaired}')
+
+
+def recompute_trend_command(args):
+    db_sess = db_session.create_session()
+    tracks = plays.recompute_trend(db_sess)
+    db_sess.close()
+    print(f'Пересчитан тренд треков: {tracks}')
+
+
+def storage_command(args):
+    db_sess = db_session.create_session()
+    moved = storage.migrate(db_sess)
+    db_sess.close()
+    print(f'Перенесено файлов в хранилище: {moved}')
+
+
+def recommendations_command(args):
+    if not recommendations.enabled():
+        raise SystemExit('Для расчёта рекомендаций нужен numpy')
+    db_sess = db_session.create_session()
+    refreshed = recommendations.refresh(db_sess, full=args.full)
+    db_sess.close()
+    print(f'Обновлены похожие треки: {refreshed}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Служебные команды Feel A Bit')
+    parser.add_argument('--db', default=DB_FILE, help='файл базы данных')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('transcode', help='создать варианты и фрагменты для уже опубликованных треков') \
+        .set_defaults(handler=transcode_command)
+    waveforms_parser = commands.add_parser('waveforms', help='рассчитать волны для треков, у которых их ещё нет')
+    waveforms_parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='число процессов')
+    waveforms_parser.set_defaults(handler=waveforms_command)
+    commands.add_parser('avatars', help='нарезать миниатюры для аватаров, загруженных раньше') \
+        .set_defaults(handler=avatars_command)
+    commands.add_parser('recompute-stats', help='пересчитать агрегаты профилей и исправить расхождения') \
+        .set_defaults(handler=recompute_stats_command)
+    commands.add_parser('storage', help='перенести ранее загруженные треки в хранилище по хэшу содержимого') \
+        .set_defaults(handler=storage_command)
+    recommendations_parser = commands.add_parser('recommendations', help='пересчитать похожие треки по общим лайкам')
+    recommendations_parser.add_argument('--full', action='store_true',
+                                        help='пересчитать все треки, а не только затронутые новыми реакциями')
+    recommendations_parser.set_defaults(handler=recommendations_command)
+    commands.add_parser('recompute-trend', help='пересчитать тренд треков по дневным сводкам прослушиваний') \
+        .set_defaults(handler=recompute_trend_command)
+    args = parser.parse_args()
+    db_session.global_init(args.db)
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
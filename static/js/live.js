@@ -0,0 +1,80 @@
+var LIVE_RETRY_MIN = 5000;
+var LIVE_RETRY_MAX = 60000;
+var liveSocket = null;
+var liveHandlers = {};
+var liveRetry = LIVE_RETRY_MIN;
+
+function liveIds(root) {
+    return Array.from(root.querySelectorAll("[data-live-id]")).map(function (element) {
+        return element.dataset.liveId;
+    });
+}
+
+function liveConnect() {
+    var ids = liveIds(document);
+    if (!ids.length || !window.WebSocket) {
+        return;
+    }
+    var protocol = location.protocol === "https:" ? "wss://" : "ws://";
+    liveSocket = new WebSocket(`${protocol}${location.host}/live?ids=${ids.join(",")}`);
+    liveSocket.onopen = function () {
+        liveRetry = LIVE_RETRY_MIN;
+    };
+    liveSocket.onmessage = function (message) {
+        liveApply(JSON.parse(message.data));
+    };
+    liveSocket.onclose = function () {
+        liveSocket = null;
+        // Сервер держит ограниченное число соединений, поэтому повторные попытки всё реже
+        setTimeout(liveConnect, liveRetry);
+        liveRetry = Math.min(liveRetry * 2, LIVE_RETRY_MAX);
+    };
+}
+
+function liveSet(audioId, name, value) {
+    document.querySelectorAll(`[data-live-id="${audioId}"] .live-${name}`).forEach(function (element) {
+        element.textContent = value;
+    });
+}
+
+function liveApply(event) {
+    if (event.type === "reaction") {
+        liveSet(event.audio_id, "likes", event.likes);
+        liveSet(event.audio_id, "dislikes", event.dislikes);
+    } else {
+        liveSet(event.audio_id, "comments", event.comments_count);
+    }
+    if (liveHandlers[event.type]) {
+        liveHandlers[event.type](event);
+    }
+}
+
+function liveHighlight(audioId, value) {
+    document.querySelectorAll(`[data-live-id="${audioId}"] a.live-react`).forEach(function (link) {
+        link.parentElement.style.backgroundColor = link.dataset.value === value ? "silver" : "";
+    });
+}
+
+document.addEventListener("click", function (event) {
+    var link = event.target.closest("a.live-react");
+    if (!link) {
+        return;
+    }
+    event.preventDefault();
+    var audioId = link.closest("[data-live-id]").dataset.liveId;
+    fetch(`/react/${audioId}`, {
+        method: "POST",
+        body: new URLSearchParams({value: link.dataset.value})
+    }).then(function (response) {
+        if (!response.ok || response.redirected) {
+            throw new Error(response.status);
+        }
+        return response.json();
+    }).then(function (result) {
+        liveApply(result);
+        liveHighlight(audioId, result.value);
+    }).catch(function () {
+        // Без авторизации или при ошибке работает обычный переход по ссылке
+        window.location = link.href;
+    });
+});
@@ -0,0 +1,28 @@
+var PLAY_THRESHOLD = 10;
+
+function playCount(audio) {
+    var match = /^\/stream\/(\d+)/.exec(audio.getAttribute("src") || "");
+    if (!match || audio.dataset.played) {
+        return;
+    }
+    // Одно прослушивание на элемент за время жизни страницы, повторы в цикле не считаются
+    audio.dataset.played = "1";
+    if (navigator.sendBeacon) {
+        navigator.sendBeacon(`/play/${match[1]}`);
+    } else {
+        fetch(`/play/${match[1]}`, {method: "POST", keepalive: true});
+    }
+}
+
+// События медиа не всплывают, поэтому слушаем их на фазе перехвата
+document.addEventListener("timeupdate", function (event) {
+    if (event.target.tagName === "AUDIO" && event.target.currentTime >= PLAY_THRESHOLD) {
+        playCount(event.target);
+    }
+}, true);
+
+document.addEventListener("ended", function (event) {
+    if (event.target.tagName === "AUDIO") {
+        playCount(event.target);
+    }
+}, true);
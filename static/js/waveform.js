@@ -0,0 +1,44 @@
+function drawWaveform(canvas) {
+    fetch(canvas.dataset.src).then(function (response) {
+        if (!response.ok) {
+            throw new Error(response.status);
+        }
+        return response.arrayBuffer();
+    }).then(function (buffer) {
+        var peaks = new Int8Array(buffer);
+        var bins = peaks.length / 2;
+        var ratio = window.devicePixelRatio || 1;
+        canvas.width = canvas.clientWidth * ratio;
+        canvas.height = canvas.clientHeight * ratio;
+        var context = canvas.getContext("2d");
+        var middle = canvas.height / 2;
+        var step = canvas.width / bins;
+        context.fillStyle = "#f0ad4e";
+        for (var i = 0; i < bins; i++) {
+            var low = peaks[2 * i] / 128 * middle;
+            var high = peaks[2 * i + 1] / 128 * middle;
+            context.fillRect(i * step, middle - high, Math.max(step - 1, 1), Math.max(high - low, 1));
+        }
+    }).catch(function () {
+        canvas.style.display = "none";
+    });
+
+    canvas.addEventListener("click", function (event) {
+        var audio = canvas.parentElement.querySelector("audio");
+        if (audio && audio.duration) {
+            audio.currentTime = audio.duration * event.offsetX / canvas.clientWidth;
+            audio.play();
+        }
+    });
+}
+
+function drawWaveforms(root) {
+    root.querySelectorAll("canvas.waveform:not([data-drawn])").forEach(function (canvas) {
+        canvas.dataset.drawn = "1";
+        drawWaveform(canvas);
+    });
+}
+
+document.addEventListener("DOMContentLoaded", function () {
+    drawWaveforms(document);
+});
@@ -0,0 +1,81 @@
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import main
+from data import db_session, storage, tasks, transcode
+from data.audio import Audio, PROCESSING, READY
+
+SAMPLE = os.path.join(ROOT, 'static', 'audio', '1.mp3')
+USER_ID = 1
+TIMEOUT = 30
+
+
+class ObjectStorePublishTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        shutil.copy(os.path.join(ROOT, 'db', 'dataB.db'), os.path.join(self.tmp, 'dataB.db'))
+        self.previous = storage.backend, transcode.VARIANTS_DIR
+        storage.configure(storage.ObjectStoreBackend(
+            storage.DirectoryObjectClient(os.path.join(self.tmp, 'objects')), 'bucket',
+            os.path.join(self.tmp, 'cache')))
+        transcode.VARIANTS_DIR = os.path.join(self.tmp, 'variants')
+        app = main.create_app(os.path.join(self.tmp, 'dataB.db'))
+        app.config['WTF_CSRF_ENABLED'] = False
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(USER_ID)
+            session['_fresh'] = True
+
+    def tearDown(self):
+        tasks.stop()
+        storage.backend, transcode.VARIANTS_DIR = self.previous
+        shutil.rmtree(self.tmp)
+
+    def _wait(self, audio_id):
+        deadline = time.monotonic() + TIMEOUT
+        while time.monotonic() < deadline:
+            db_sess = db_session.create_session()
+            try:
+                audio = db_sess.query(Audio).get(audio_id)
+                if audio.status != PROCESSING:
+                    return audio
+            finally:
+                db_sess.close()
+            time.sleep(0.1)
+        self.fail(f'Трек {audio_id} не обработан за {TIMEOUT} с')
+
+    def test_publish(self):
+        with open(SAMPLE, 'rb') as file:
+            data = file.read()
+        response = self.client.post('/publish', data={'file': (io.BytesIO(data), 'track.mp3')},
+                                    content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 302)
+
+        db_sess = db_session.create_session()
+        try:
+            audio_id, content_hash = db_sess.query(Audio.id, Audio.file_hash).order_by(Audio.id.desc()).first()
+        finally:
+            db_sess.close()
+        name = storage.key(content_hash)
+        self.assertTrue(storage.backend.exists(name))
+        self.assertEqual(os.listdir(storage.backend.staging_dir), [])
+
+        # Файл скачивается в кэш при обработке, а не при публикации
+        self.assertEqual(self._wait(audio_id).status, READY)
+        response = self.client.get(f'/stream/{audio_id}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_data(), data)
+        response.close()
+
+
+if __name__ == '__main__':
+    unittest.main()